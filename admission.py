@@ -0,0 +1,345 @@
+import os
+import math
+import time
+import json
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+# Контроль допуска для POST /api/new_orders.
+# 1. Задержка очереди: фоновая задача замеряет, насколько event loop опаздывает
+#    с запуском готовых задач (сюда же попадают еще не начатые запросы). Пока
+#    опоздание больше ADMISSION_MAX_QUEUE_DELAY_MS - 503 без выполнения заказа.
+# 2. Адаптивный лимит одновременных запросов (AIMD по задержке): пока короткое
+#    скользящее среднее задержки успешных заказов не превышает базовую в
+#    ADMISSION_LATENCY_TOLERANCE раз, лимит растет на единицу, иначе
+#    умножается на ADMISSION_BACKOFF. Задержка отмен (SMS внутри запроса)
+#    в среднее не попадает, а снижаем лимит, только когда он почти выбран -
+#    иначе медленная отмена при малой нагрузке выглядела бы как перегрузка.
+#    Сверх лимита - 503.
+# 3. Token bucket на каждого client_id. Пустой bucket - 429.
+# 4. Лимит фоновых задач отправки в Kafka: пока очередь переполнена - 503.
+# Во всех отказах возвращаем Retry-After.
+# Проверка под нагрузкой выше насыщения: python admission.py bench
+
+
+def _env_float(name: str, default: str) -> float:
+    return float(os.getenv(name, default))
+
+
+class AdmissionConfig:
+    def __init__(self):
+        self.enabled = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.initial_limit = _env_float("ADMISSION_INITIAL_LIMIT", "200")
+        self.min_limit = _env_float("ADMISSION_MIN_LIMIT", "10")
+        self.max_limit = _env_float("ADMISSION_MAX_LIMIT", "2000")
+        # Во сколько раз задержка может превысить базовую, прежде чем лимит начнет падать
+        self.latency_tolerance = _env_float("ADMISSION_LATENCY_TOLERANCE", "2.0")
+        # Абсолютный порог задержки, мс (0 - не использовать)
+        self.target_latency_ms = _env_float("ADMISSION_TARGET_LATENCY_MS", "0")
+        self.backoff = _env_float("ADMISSION_BACKOFF", "0.9")
+        # С какой доли лимита одновременных запросов он считается выбранным
+        self.busy_share = _env_float("ADMISSION_BUSY_SHARE", "0.5")
+        # Допустимое опоздание event loop, мс (0 - не проверять) и период замера
+        self.max_queue_delay_ms = _env_float("ADMISSION_MAX_QUEUE_DELAY_MS", "50")
+        self.queue_probe_ms = _env_float("ADMISSION_QUEUE_PROBE_MS", "10")
+        # Запросов в секунду на клиента и размер пачки (rate 0 - без ограничения)
+        self.client_rate = _env_float("ADMISSION_CLIENT_RATE", "10")
+        self.client_burst = _env_float("ADMISSION_CLIENT_BURST", "20")
+        self.max_buckets = int(os.getenv("ADMISSION_MAX_BUCKETS", "100000"))
+        # Максимум одновременно висящих задач send_to_kafka
+        self.max_background_tasks = int(os.getenv("ADMISSION_MAX_BACKGROUND_TASKS", "1000"))
+
+    def as_dict(self) -> Dict:
+        return dict(self.__dict__)
+
+
+class AdmissionRejected(Exception):
+  #запрос отклонен контролем допуска
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+
+class AdmissionController:
+    def __init__(self, config: AdmissionConfig):
+        self.config = config
+        self.limit = config.initial_limit
+        self.inflight = 0
+        # короткое и длинное скользящие средние задержки, секунды
+        self.fast_latency: Optional[float] = None
+        self.baseline_latency: Optional[float] = None
+        # сглаженное опоздание event loop, секунды
+        self.queue_delay = 0.0
+        self.buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.background_tasks: Set[asyncio.Task] = set()
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"queue_delay": 0, "concurrency": 0, "client_rate": 0, "background_tasks": 0}
+
+    def _retry_after_overload(self) -> int:
+        return max(1, math.ceil(self.fast_latency or 1.0))
+
+    def _busy(self) -> bool:
+        return self.inflight + 1 >= self.limit * self.config.busy_share
+
+    def _back_off(self) -> None:
+        self.limit = max(self.config.min_limit, self.limit * self.config.backoff)
+
+    async def monitor_queue_delay(self) -> None:
+        #фоновая задача: замер опоздания event loop, запускается при старте приложения
+        while True:
+            interval = self.config.queue_probe_ms / 1000
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            delay = max(0.0, time.monotonic() - started - interval)
+            # рост учитываем сразу, спад - сглаженно
+            self.queue_delay = delay if delay > self.queue_delay else 0.7 * self.queue_delay + 0.3 * delay
+
+    def _queue_overloaded(self) -> bool:
+        return self.config.max_queue_delay_ms > 0 and self.queue_delay * 1000 > self.config.max_queue_delay_ms
+
+    def _take_token(self, client_id: int, now: float) -> Optional[int]:
+        #берет токен клиента, при пустом bucket возвращает Retry-After в секундах
+        rate = self.config.client_rate
+        if rate <= 0:
+            return None
+        bucket = self.buckets.get(client_id)
+        if bucket is None:
+            bucket = self.buckets[client_id] = TokenBucket(self.config.client_burst, now)
+            if len(self.buckets) > self.config.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client_id)
+            bucket.tokens = min(self.config.client_burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        if bucket.tokens < 1:
+            return max(1, math.ceil((1 - bucket.tokens) / rate))
+        bucket.tokens -= 1
+        return None
+
+    def admit(self, client_id: int) -> Optional[float]:
+        #пропускает запрос или бросает AdmissionRejected, возвращает время старта
+        if not self.config.enabled:
+            return None
+        if self._queue_overloaded():
+            self.rejected["queue_delay"] += 1
+            raise AdmissionRejected(503, "Сервис перегружен, повторите запрос позже", max(1, math.ceil(self.queue_delay)))
+        if self.inflight >= self.limit:
+            self.rejected["concurrency"] += 1
+            raise AdmissionRejected(503, "Сервис перегружен, повторите запрос позже", self._retry_after_overload())
+        if len(self.background_tasks) >= self.config.max_background_tasks:
+            self.rejected["background_tasks"] += 1
+            raise AdmissionRejected(503, "Очередь отправки в Kafka переполнена, повторите запрос позже", self._retry_after_overload())
+        now = time.monotonic()
+        retry_after = self._take_token(client_id, now)
+        if retry_after is not None:
+            self.rejected["client_rate"] += 1
+            raise AdmissionRejected(429, f"Слишком много заказов от клиента {client_id}", retry_after)
+        self.inflight += 1
+        self.admitted += 1
+        return now
+
+    def release(self, started: Optional[float], sample: bool = True) -> None:
+        #освобождает место запроса; при sample учитывает его задержку и подстраивает лимит
+        if started is None:
+            return
+        self.inflight -= 1
+        if not sample:
+            return
+        latency = time.monotonic() - started
+        if self.fast_latency is None:
+            self.fast_latency = self.baseline_latency = latency
+            return
+        self.fast_latency = 0.8 * self.fast_latency + 0.2 * latency
+        # базовая задержка быстро идет вниз и медленно вверх
+        if latency < self.baseline_latency:
+            self.baseline_latency = latency
+        else:
+            self.baseline_latency = 0.99 * self.baseline_latency + 0.01 * latency
+
+        overloaded = self.fast_latency > self.baseline_latency * self.config.latency_tolerance
+        if self.config.target_latency_ms > 0 and self.fast_latency * 1000 > self.config.target_latency_ms:
+            overloaded = True
+        if overloaded and self._busy():
+            self._back_off()
+        elif not overloaded and self._busy():
+            # растем, только когда лимит действительно используется
+            self.limit = min(self.config.max_limit, self.limit + 1)
+
+    def spawn_background(self, coro) -> asyncio.Task:
+        #fire-and-forget задача с учетом в лимите фоновых задач
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    def stats(self) -> Dict:
+        return {
+            "config": self.config.as_dict(),
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "background_tasks": len(self.background_tasks),
+            "queue_delay_ms": round(self.queue_delay * 1000, 3),
+            "latency_ms": round(self.fast_latency * 1000, 3) if self.fast_latency is not None else None,
+            "baseline_latency_ms": round(self.baseline_latency * 1000, 3) if self.baseline_latency is not None else None,
+            "client_buckets": len(self.buckets),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected)
+        }
+
+    def configure(self, **settings) -> Dict:
+        #меняет настройки на лету, None - оставить как есть
+        for name, value in settings.items():
+            if value is not None and hasattr(self.config, name):
+                setattr(self.config, name, value)
+        self.limit = min(max(self.limit, self.config.min_limit), self.config.max_limit)
+        return self.stats()
+
+
+controller = AdmissionController(AdmissionConfig())
+
+
+#### нагрузочная проверка
+
+def _bench_tables(items: int) -> Dict:
+    #исходные таблицы: items доступных вещей в постомате 789, вещь 457 занята
+    import services
+    tables = services.dump_tables()
+    tables["orders_db"] = []
+    tables["items_db"] = [i for i in tables["items_db"] if i["id"] == 457] + [
+        {"id": 1000 + n, "desc": f"Вещь {n}", "hourly_price": 10, "is_available_now": True,
+         "current_pickup_point_id": 789, "reserved_until": None}
+        for n in range(items)
+    ]
+    return tables
+
+
+async def _bench_phase(app, tables: Dict, rate: Optional[float], concurrency: int, duration: float,
+                       cancel_share: float, enabled: bool, seed: int) -> Dict:
+    #одна фаза: при rate=None замкнутая нагрузка из concurrency потоков, иначе открытая с частотой rate
+    import random
+    import itertools
+    import admission
+    import services
+    from replay import call_app, percentile
+
+    services.load_tables(tables)
+    # свежий контроллер на фазу; main берет его как admission.controller
+    # (при запуске python admission.py этот модуль - __main__, а не admission)
+    controller = admission.controller = admission.AdmissionController(admission.AdmissionConfig())
+    controller.config.enabled = enabled
+    # проверяем перегрузку, а не лимит на клиента
+    controller.config.client_rate = 0
+    monitor = asyncio.create_task(controller.monitor_queue_delay())
+
+    rng = random.Random(seed)
+    # вещи по кругу: когда свободные кончатся, заказы начнут отменяться как занятые
+    next_item = itertools.cycle(range(1000, 1000 + len(tables["items_db"]) - 1))
+    latencies: Dict[int, list] = {}
+
+    async def one(scheduled: float):
+        # занятая вещь 457 - заказ отменяется с SMS, остальные бронируются
+        item_id = 457 if rng.random() < cancel_share else next(next_item)
+        body = json.dumps({"client_id": 123, "item_id": item_id, "pickup_point_id": 789, "rental_duration_hours": 1})
+        try:
+            status_code, _ = await call_app(app, "POST", "/api/new_orders", "", body.encode())
+        except Exception:
+            status_code = 500
+        # задержка от запланированного момента отправки, а не от фактического
+        latencies.setdefault(status_code, []).append(time.monotonic() - scheduled)
+
+    started = time.monotonic()
+    tasks = []
+    if rate is None:
+        async def worker():
+            while time.monotonic() - started < duration:
+                await one(time.monotonic())
+        tasks = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    else:
+        sent = 0
+        total = int(rate * duration)
+        while sent < total:
+            due = min(total, int((time.monotonic() - started) * rate))
+            while sent < due:
+                sent += 1
+                tasks.append(asyncio.create_task(one(started + sent / rate)))
+            await asyncio.sleep(0.002)
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    monitor.cancel()
+
+    everything = [lat for values in latencies.values() for lat in values]
+    served = latencies.get(201, []) + latencies.get(409, [])
+    return {
+        "requests": len(everything),
+        "statuses": {str(code): len(values) for code, values in sorted(latencies.items())},
+        "orders_per_s": round(len(latencies.get(201, [])) / elapsed, 1),
+        "served_p50_ms": round(percentile(served, 50) * 1000, 1),
+        "served_p99_ms": round(percentile(served, 99) * 1000, 1),
+        "all_p99_ms": round(percentile(everything, 99) * 1000, 1),
+        "limit": round(controller.limit, 1)
+    }
+
+
+def bench(duration: float, concurrency: int, overload: float, cancel_share: float, items: int, max_p99_ms: float, seed: int) -> bool:
+    #замеряет насыщение, затем дает overload x насыщение с контролем допуска и без
+    import io
+    import contextlib
+    import main as app_module
+
+    tables = _bench_tables(items)
+
+    def phase(rate, enabled):
+        # вывод сервисов (print на каждый шаг заказа) глушим
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(_bench_phase(app_module.app, tables, rate, concurrency, duration, cancel_share, enabled, seed))
+
+    saturation = phase(None, False)
+    total_rate = saturation["requests"] / duration
+    print(f"насыщение: {total_rate:.0f} запросов/с (заказов {saturation['orders_per_s']}/с), "
+          f"p99 {saturation['served_p99_ms']} мс при {concurrency} потоках")
+
+    rate = total_rate * overload
+    print(f"нагрузка {overload:g}x насыщения: {rate:.0f} запросов/с в течение {duration:g} с")
+    results = {}
+    for enabled in (False, True):
+        results[enabled] = phase(rate, enabled)
+        print(f"  контроль допуска {'вкл ' if enabled else 'выкл'}: {json.dumps(results[enabled], ensure_ascii=False)}")
+
+    # отработанные запросы (201 и 409) не должны ждать в очереди, сколько бы запросов ни пришло
+    ok = results[True]["served_p99_ms"] <= max_p99_ms
+    print(f"p99 отработанных запросов с контролем допуска {results[True]['served_p99_ms']} мс, "
+          f"граница {max_p99_ms:g} мс: {'OK' if ok else 'ПРЕВЫШЕНА'}")
+    return ok
+
+
+def main(argv=None) -> None:
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="Контроль допуска POST /api/new_orders")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench_parser = sub.add_parser("bench", help="нагрузка выше насыщения с контролем допуска и без")
+    bench_parser.add_argument("--duration", type=float, default=5.0, help="длительность фазы, с")
+    bench_parser.add_argument("--concurrency", type=int, default=64, help="потоков при замере насыщения")
+    bench_parser.add_argument("--overload", type=float, default=2.0, help="во сколько раз нагрузка выше насыщения")
+    bench_parser.add_argument("--cancel-share", type=float, default=0.2, help="доля заказов, которые отменяются")
+    bench_parser.add_argument("--items", type=int, default=3000, help="свободных вещей в начале фазы")
+    bench_parser.add_argument("--max-p99-ms", type=float, default=1000, help="граница p99 отработанных запросов, мс")
+    bench_parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    if not bench(args.duration, args.concurrency, args.overload, args.cancel_share, args.items, args.max_p99_ms, args.seed):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
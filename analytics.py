@@ -0,0 +1,135 @@
+from typing import Dict, List, Optional, Iterable, Callable
+from models import Order, OrderStatus, CancelReason
+
+# Материализованные агрегаты по вещам и постоматам.
+# Счетчики обновляются при каждом изменении заказа: вычитаем вклад старого
+# состояния заказа и добавляем вклад нового, поэтому чтение не сканирует orders_db.
+
+# Статусы, в которых вещь считается в активной аренде
+ACTIVE_ORDER_STATUSES = (OrderStatus.AWAITING_PAYMENT, OrderStatus.AWAITING_RECEIPT, OrderStatus.AWAITING_RETURN)
+# Статусы, в которых бронь состоялась и часы/выручка засчитываются
+BOOKED_ORDER_STATUSES = ACTIVE_ORDER_STATUSES + (OrderStatus.RETURNED,)
+
+_by_item: Dict[int, Dict] = {}
+_by_pickup_point: Dict[int, Dict] = {}
+
+
+def _empty_stats() -> Dict:
+    return {
+        "orders": 0,
+        "active_rentals": 0,
+        "cancelled": 0,
+        "cancel_reasons": {reason.value: 0 for reason in CancelReason},
+        "booked_hours": 0,
+        "revenue": 0
+    }
+
+
+def _apply(by_item: Dict[int, Dict], by_pickup_point: Dict[int, Dict], order: Order, hourly_price: int, sign: int) -> None:
+    #добавляет (sign=1) или вычитает (sign=-1) вклад заказа в агрегаты
+    for table, key in ((by_item, order.item_id), (by_pickup_point, order.pickup_point_id)):
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = _empty_stats()
+        stats["orders"] += sign
+        if order.status in ACTIVE_ORDER_STATUSES:
+            stats["active_rentals"] += sign
+        if order.status in BOOKED_ORDER_STATUSES:
+            stats["booked_hours"] += sign * order.rental_duration_hours
+            stats["revenue"] += sign * order.rental_duration_hours * hourly_price
+        if order.status == OrderStatus.CANCELLED:
+            stats["cancelled"] += sign
+            reason = order.cancel_reason or CancelReason.OTHER
+            stats["cancel_reasons"][reason.value] += sign
+
+
+def record_order_change(old: Optional[Order], new: Optional[Order], hourly_price: int) -> None:
+    #вызывается сервисами при создании заказа (old=None) и каждом изменении его состояния
+    if old is not None:
+        _apply(_by_item, _by_pickup_point, old, hourly_price, -1)
+    if new is not None:
+        _apply(_by_item, _by_pickup_point, new, hourly_price, 1)
+
+
+def _with_rates(stats: Dict) -> Dict:
+    result = dict(stats)
+    result["cancel_reasons"] = dict(stats["cancel_reasons"])
+    result["cancellation_rate"] = stats["cancelled"] / stats["orders"] if stats["orders"] else 0.0
+    result["cancel_reason_rates"] = {
+        reason: (count / stats["orders"] if stats["orders"] else 0.0)
+        for reason, count in stats["cancel_reasons"].items()
+    }
+    return result
+
+
+def get_item_stats(item_id: int) -> Dict:
+    return _with_rates(_by_item.get(item_id) or _empty_stats())
+
+
+def get_pickup_point_stats(pickup_point_id: int) -> Dict:
+    return _with_rates(_by_pickup_point.get(pickup_point_id) or _empty_stats())
+
+
+def snapshot() -> Dict:
+    #текущие инкрементальные агрегаты
+    return {
+        "items": {key: _with_rates(stats) for key, stats in _by_item.items()},
+        "pickup_points": {key: _with_rates(stats) for key, stats in _by_pickup_point.items()}
+    }
+
+
+def merge_stats(parts: List[Dict]) -> Dict:
+    #сводит счетчики одной вещи или постомата из нескольких шардов, доли пересчитываются
+    total = _empty_stats()
+    for stats in parts:
+        for field in ("orders", "active_rentals", "cancelled", "booked_hours", "revenue"):
+            total[field] += stats[field]
+        for reason, count in stats["cancel_reasons"].items():
+            total["cancel_reasons"][reason] += count
+    return _with_rates(total)
+
+
+def merge_snapshots(snapshots: List[Dict]) -> Dict:
+    #сводит снимки (snapshot или compute_from_scratch) нескольких шардов
+    result = {}
+    for name in ("items", "pickup_points"):
+        parts: Dict[int, List[Dict]] = {}
+        for part in snapshots:
+            # после JSON ключи - строки
+            for key, stats in part[name].items():
+                parts.setdefault(int(key), []).append(stats)
+        result[name] = {key: merge_stats(stats) for key, stats in parts.items()}
+    return result
+
+
+def compute_from_scratch(orders: Iterable[Order], price_of: Callable[[int], int]) -> Dict:
+    #пересчитывает агрегаты полным проходом по заказам (для проверки инкрементальных)
+    by_item: Dict[int, Dict] = {}
+    by_pickup_point: Dict[int, Dict] = {}
+    for order in orders:
+        _apply(by_item, by_pickup_point, order, price_of(order.item_id), 1)
+    return {
+        "items": {key: _with_rates(stats) for key, stats in by_item.items()},
+        "pickup_points": {key: _with_rates(stats) for key, stats in by_pickup_point.items()}
+    }
+
+
+def _drop_empty(tables: Dict) -> Dict:
+    # ключи, у которых все заказы ушли, после вычитаний остаются с нулями
+    return {
+        name: {key: stats for key, stats in table.items() if stats["orders"] != 0}
+        for name, table in tables.items()
+    }
+
+
+def is_consistent(rebuilt: Dict) -> bool:
+    #сравнивает инкрементальные агрегаты с пересчитанными
+    return _drop_empty(snapshot()) == _drop_empty(rebuilt)
+
+
+def reset(orders: Iterable[Order] = (), price_of: Callable[[int], int] = lambda item_id: 0) -> None:
+    #сбрасывает агрегаты и заполняет их заново из переданных заказов
+    _by_item.clear()
+    _by_pickup_point.clear()
+    for order in orders:
+        _apply(_by_item, _by_pickup_point, order, price_of(order.item_id), 1)
@@ -0,0 +1,316 @@
+import os
+import zlib
+import json
+import glob
+import mmap
+import bisect
+import struct
+import hashlib
+import threading
+from typing import List, Optional, Iterator
+from models import Order
+
+# Архив завершенных заказов (холодное хранилище).
+# Заказы пишутся в неизменяемые сегменты: каждый сегмент - это набор блоков,
+# блок - сжатые zlib строки JSON заказов, отсортированных по id.
+# Рядом с сегментом лежит разреженный индекс (.idx): число заказов и по одной
+# записи на блок [первый id, последний id, смещение, длина]. В памяти процесса
+# держим только эти индексы, поэтому она растет с числом блоков, а не заказов.
+# id заказов случайные, поэтому диапазон [первый, последний] почти любого сегмента
+# покрывает все id. Чтобы поиск по id не читал по блоку из каждого сегмента,
+# у сегмента есть фильтр Блума (.bloom, ~10 бит на заказ, около 1% ложных
+# срабатываний). Фильтры не загружаются в память, а отображаются через mmap:
+# поиск читает 7 бит фильтра, остальное лежит на диске или в page cache.
+# Мелкие сегменты (каждый проход архивации пишет свой) сливаются в полные,
+# когда их набирается больше ARCHIVE_COMPACT_SEGMENTS.
+#
+# Архивация идет в отдельном потоке (services.archive_finished_orders), а поток
+# выгрузки /api/get_orders - в threadpool, поэтому список сегментов защищен
+# _lock, а сегмент, который читают, после слияния удаляется с диска только
+# когда его отпустит последний читатель.
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Сколько заказов кладем в один сжатый блок
+ARCHIVE_BLOCK_SIZE = int(os.getenv("ARCHIVE_BLOCK_SIZE", "256"))
+# Максимум заказов в одном сегменте
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", "65536"))
+# Сколько неполных сегментов допускаем, прежде чем слить их в один
+ARCHIVE_COMPACT_SEGMENTS = int(os.getenv("ARCHIVE_COMPACT_SEGMENTS", "8"))
+# Бит фильтра Блума на заказ (10 бит и 7 хешей - около 1% ложных срабатываний)
+ARCHIVE_BLOOM_BITS_PER_ORDER = 10
+_BLOOM_HASHES = 7
+_BLOOM_HEADER = struct.Struct("!II")
+
+
+class ArchiveError(Exception):
+  #ошибка чтения/записи архива
+    pass
+
+
+def _bloom_positions(order_id: int, bits: int) -> List[int]:
+    # двойное хеширование: h1 + i*h2 вместо k независимых хешей
+    digest = hashlib.blake2b(order_id.to_bytes(8, "big", signed=True), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % bits for i in range(_BLOOM_HASHES)]
+
+
+def _build_bloom(ids: List[int]) -> bytes:
+    bits = max(64, len(ids) * ARCHIVE_BLOOM_BITS_PER_ORDER)
+    data = bytearray((bits + 7) // 8)
+    for order_id in ids:
+        for pos in _bloom_positions(order_id, bits):
+            data[pos >> 3] |= 1 << (pos & 7)
+    return _BLOOM_HEADER.pack(bits, _BLOOM_HASHES) + bytes(data)
+
+
+class _Segment:
+    #сегмент на диске: индекс блоков в памяти, фильтр Блума через mmap
+    def __init__(self, path: str, count: int, entries: List[List[int]]):
+        self.path = path
+        self.count = count
+        self.entries = entries
+        self.first_ids = [e[0] for e in entries]
+        self.last_id = entries[-1][1]
+        # сколько потоков сейчас читают сегмент и выведен ли он из архива слиянием
+        self.readers = 0
+        self.retired = False
+        with open(path[:-4] + ".bloom", "rb") as f:
+            self._bloom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._bits, hashes = _BLOOM_HEADER.unpack_from(self._bloom)
+        if hashes != _BLOOM_HASHES:
+            raise ArchiveError(f"Фильтр Блума {path} с {hashes} хешами не поддерживается")
+
+    def might_contain(self, order_id: int) -> bool:
+        if order_id < self.first_ids[0] or order_id > self.last_id:
+            return False
+        base = _BLOOM_HEADER.size
+        return all(self._bloom[base + (pos >> 3)] & (1 << (pos & 7)) for pos in _bloom_positions(order_id, self._bits))
+
+    def remove_files(self) -> None:
+        self._bloom.close()
+        # сначала индекс: без него сегмент уже не виден при загрузке
+        for suffix in (".idx", ".bloom", ".seg"):
+            path = self.path[:-4] + suffix
+            if os.path.exists(path):
+                os.remove(path)
+
+
+_lock = threading.RLock()
+# Сегменты архива от старых к новым
+_segments: List[_Segment] = []
+_loaded = False
+_next_num = 1
+# Слияние идет в одном потоке за раз
+_compacting = threading.Lock()
+
+
+def _segment_paths() -> List[str]:
+    return sorted(glob.glob(os.path.join(ARCHIVE_DIR, "segment_*.seg")))
+
+
+def _segment_num(seg_path: str) -> int:
+    return int(os.path.basename(seg_path)[8:-4])
+
+
+def _load_index() -> None:
+    #подгружаем разреженные индексы всех сегментов с диска
+    global _loaded, _next_num
+    with _lock:
+        if _loaded:
+            return
+        _segments.clear()
+        paths = _segment_paths()
+        for seg_path in paths:
+            idx_path = seg_path[:-4] + ".idx"
+            if not os.path.exists(idx_path):
+                # сегмент без индекса - запись прервалась, пропускаем
+                print(f"[ARCHIVE] Сегмент {seg_path} без индекса, пропущен")
+                continue
+            with open(idx_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            _segments.append(_Segment(seg_path, index["count"], index["blocks"]))
+        _next_num = _segment_num(paths[-1]) + 1 if paths else 1
+        _loaded = True
+
+
+def _new_segment_path() -> str:
+    global _next_num
+    with _lock:
+        num = _next_num
+        _next_num += 1
+    return os.path.join(ARCHIVE_DIR, f"segment_{num:06d}.seg")
+
+
+def _write_segment(orders: List[Order]) -> _Segment:
+    #пишет один сегмент, его фильтр и индекс; в список сегментов не добавляет
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    seg_path = _new_segment_path()
+    idx_path = seg_path[:-4] + ".idx"
+    bloom_path = seg_path[:-4] + ".bloom"
+
+    entries = []
+    offset = 0
+    with open(seg_path + ".tmp", "wb") as f:
+        for start in range(0, len(orders), ARCHIVE_BLOCK_SIZE):
+            block = orders[start:start + ARCHIVE_BLOCK_SIZE]
+            raw = "\n".join(o.model_dump_json() for o in block).encode("utf-8")
+            data = zlib.compress(raw)
+            f.write(data)
+            entries.append([block[0].id, block[-1].id, offset, len(data)])
+            offset += len(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(seg_path + ".tmp", seg_path)
+
+    with open(bloom_path + ".tmp", "wb") as f:
+        f.write(_build_bloom([o.id for o in orders]))
+    os.replace(bloom_path + ".tmp", bloom_path)
+
+    # индекс пишем последним: сегмент виден только когда у него есть индекс
+    with open(idx_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"count": len(orders), "blocks": entries}, f)
+    os.replace(idx_path + ".tmp", idx_path)
+    return _Segment(seg_path, len(orders), entries)
+
+
+def _write_orders(orders: List[Order]) -> List[_Segment]:
+    orders = sorted(orders, key=lambda o: o.id)
+    written = []
+    for start in range(0, len(orders), ARCHIVE_SEGMENT_SIZE):
+        segment = _write_segment(orders[start:start + ARCHIVE_SEGMENT_SIZE])
+        print(f"[ARCHIVE] Записан сегмент {segment.path}")
+        written.append(segment)
+    return written
+
+
+def _acquire(segments: List[_Segment]) -> None:
+    with _lock:
+        for segment in segments:
+            segment.readers += 1
+
+
+def _release(segments: List[_Segment]) -> None:
+    with _lock:
+        for segment in segments:
+            segment.readers -= 1
+            if segment.retired and segment.readers == 0:
+                segment.remove_files()
+
+
+def _snapshot() -> List[_Segment]:
+    #текущий список сегментов, каждый захвачен для чтения (отпустить через _release)
+    _load_index()
+    with _lock:
+        segments = list(_segments)
+        _acquire(segments)
+    return segments
+
+
+def compact(force: bool = False) -> int:
+    #сливает неполные сегменты в полные, возвращает число слитых сегментов
+    _load_index()
+    if not _compacting.acquire(blocking=False):
+        return 0
+    try:
+        with _lock:
+            small = [s for s in _segments if s.count < ARCHIVE_SEGMENT_SIZE]
+            if len(small) < 2 or (not force and len(small) <= ARCHIVE_COMPACT_SEGMENTS):
+                return 0
+            _acquire(small)
+        try:
+            # чтение и запись идут без _lock: поиск и выгрузка в это время работают
+            orders = [order for segment in small for entry in segment.entries for order in _read_block(segment.path, entry)]
+            written = _write_orders(orders)
+        finally:
+            _release(small)
+
+        # новые сегменты становятся видимыми раньше, чем удаляются старые, поэтому
+        # при сбое посередине заказ может оказаться в двух сегментах, но не потеряется
+        with _lock:
+            retired = set(id(s) for s in small)
+            _segments[:] = [s for s in _segments if id(s) not in retired] + written
+            for segment in small:
+                segment.retired = True
+                if segment.readers == 0:
+                    segment.remove_files()
+        print(f"[ARCHIVE] Слито сегментов: {len(small)}, заказов: {len(orders)}")
+        return len(small)
+    finally:
+        _compacting.release()
+
+
+def append_orders(orders: List[Order]) -> int:
+    #добавляет заказы в архив новыми сегментами, возвращает число записанных заказов
+    _load_index()
+    if not orders:
+        return 0
+    written = _write_orders(orders)
+    with _lock:
+        _segments.extend(written)
+    compact()
+    return len(orders)
+
+
+def _read_block(seg_path: str, entry: List[int]) -> List[Order]:
+    _, _, offset, length = entry
+    try:
+        with open(seg_path, "rb") as f:
+            f.seek(offset)
+            raw = zlib.decompress(f.read(length))
+    except (OSError, zlib.error) as e:
+        raise ArchiveError(f"Не удалось прочитать блок архива {seg_path}: {e}")
+    return [Order.model_validate_json(line) for line in raw.decode("utf-8").split("\n")]
+
+
+def get_order(order_id: int) -> Optional[Order]:
+    #ищет заказ в архиве по id, блок читается только у сегментов, чей фильтр Блума пропустил id
+    segments = _snapshot()
+    try:
+        # идем от новых сегментов к старым
+        for segment in reversed(segments):
+            if not segment.might_contain(order_id):
+                continue
+            block_num = bisect.bisect_right(segment.first_ids, order_id) - 1
+            if segment.entries[block_num][1] < order_id:
+                continue
+            for order in _read_block(segment.path, segment.entries[block_num]):
+                if order.id == order_id:
+                    return order
+        return None
+    finally:
+        _release(segments)
+
+
+def iter_orders() -> Iterator[Order]:
+    #потоково отдает все заказы архива, по одному блоку в памяти;
+    #сегменты, слитые во время выгрузки, дочитываются до конца
+    segments = _snapshot()
+    try:
+        for segment in segments:
+            for entry in segment.entries:
+                for order in _read_block(segment.path, entry):
+                    yield order
+    finally:
+        _release(segments)
+
+
+def segments_count() -> int:
+    _load_index()
+    with _lock:
+        return len(_segments)
+
+
+def clear() -> None:
+    #удаляет все сегменты архива (для /api/debug/reset)
+    global _loaded
+    with _lock:
+        for segment in _segments:
+            segment.retired = True
+            if segment.readers == 0:
+                segment.remove_files()
+        _segments.clear()
+        # и файлы, которые не попали в индекс (например, прерванная запись)
+        for path in glob.glob(os.path.join(ARCHIVE_DIR, "segment_*")):
+            os.remove(path)
+        _loaded = False
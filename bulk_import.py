@@ -0,0 +1,389 @@
+import gc
+import os
+import csv
+import json
+import random
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from models import Item, Client
+import services
+import sharding
+
+# Массовый импорт вещей и клиентов из CSV/NDJSON.
+# Тело запроса читается потоково и режется на пачки строк. Разбор строк и
+# проверки, не зависящие от остальных строк (пустые поля, цена, постомат),
+# идут параллельно в пуле процессов. Уникальность id, phone и email
+# проверяется в основном процессе одним проходом по хеш-множествам.
+# Выдача id и сборка моделей идут в отдельном потоке, индексация для поиска -
+# пачками, поэтому большой импорт не останавливает остальные запросы.
+# CSV должен быть с заголовком и без переносов строк внутри полей, в UTF-8.
+# id шестизначные, их всего 900000 на таблицу: строки сверх свободных id
+# не загружаются и попадают в отчет с ошибкой "Нет свободных id".
+
+# Число процессов пула (0 - проверять в основном процессе)
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", str(os.cpu_count() or 1)))
+# Сколько строк отправляем в процесс одной пачкой
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "20000"))
+
+# Всего шестизначных id
+ID_SPACE = 900000
+
+ITEM_FIELDS = ("desc", "hourly_price", "current_pickup_point_id")
+CLIENT_FIELDS = ("name", "phone", "email")
+
+_pool: Optional[ProcessPoolExecutor] = None
+# Сколько импортов сейчас идет с выключенным сборщиком мусора
+_gc_pauses = 0
+_gc_was_enabled = True
+
+
+class ImportFormatError(Exception):
+  #ошибка формата загружаемого файла
+    pass
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if IMPORT_WORKERS <= 0:
+        return None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMPORT_WORKERS)
+    return _pool
+
+
+def _parse_lines(fmt: str, header: Optional[List[str]], lines: List[str], first_row: int):
+    #разбирает пачку строк, возвращает [(номер строки, dict или текст ошибки)]
+    result = []
+    if fmt == "csv":
+        for offset, values in enumerate(csv.reader(lines)):
+            row_num = first_row + offset
+            if len(values) != len(header):
+                result.append((row_num, f"Ожидалось полей: {len(header)}, получено: {len(values)}"))
+            else:
+                result.append((row_num, dict(zip(header, values))))
+    else:
+        for offset, line in enumerate(lines):
+            row_num = first_row + offset
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                result.append((row_num, f"Некорректный JSON: {e}"))
+                continue
+            if not isinstance(row, dict):
+                result.append((row_num, "Строка должна быть JSON-объектом"))
+            else:
+                result.append((row_num, row))
+    return result
+
+
+def _as_int(value) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+
+def validate_items_chunk(fmt: str, header: Optional[List[str]], lines: List[str], first_row: int, pickup_point_ids: Set[int]):
+    #проверяет пачку строк с вещами, выполняется в процессе пула
+    valid = []
+    errors = []
+    for row_num, row in _parse_lines(fmt, header, lines, first_row):
+        if isinstance(row, str):
+            errors.append({"row": row_num, "errors": [row]})
+            continue
+        row_errors = []
+        desc = row.get("desc")
+        hourly_price = _as_int(row.get("hourly_price"))
+        pickup_point_id = _as_int(row.get("current_pickup_point_id"))
+
+        if not isinstance(desc, str) or desc == '':
+            row_errors.append("Нельзя зарегистрировать item с пустым desc")
+        if hourly_price is None:
+            row_errors.append("hourly_price должен быть целым числом")
+        elif hourly_price <= 0:
+            row_errors.append("Нельзя зарегистрировать item с hourly_price <= 0")
+        if pickup_point_id is None:
+            row_errors.append("current_pickup_point_id должен быть целым числом")
+        elif pickup_point_id not in pickup_point_ids:
+            row_errors.append(f"Не существует pickup_point с id {pickup_point_id}")
+
+        if row_errors:
+            errors.append({"row": row_num, "errors": row_errors})
+        else:
+            valid.append((row_num, desc, hourly_price, pickup_point_id))
+    return valid, errors
+
+
+def validate_clients_chunk(fmt: str, header: Optional[List[str]], lines: List[str], first_row: int):
+    #проверяет пачку строк с клиентами, выполняется в процессе пула
+    valid = []
+    errors = []
+    for row_num, row in _parse_lines(fmt, header, lines, first_row):
+        if isinstance(row, str):
+            errors.append({"row": row_num, "errors": [row]})
+            continue
+        values = [row.get(field) for field in CLIENT_FIELDS]
+        if any(not isinstance(value, str) or value == '' for value in values):
+            errors.append({"row": row_num, "errors": ["Нельзя зарегистрировать client без полей name, email, phone"]})
+        else:
+            valid.append((row_num, *values))
+    return valid, errors
+
+
+async def _iter_chunks(body: AsyncIterator[bytes], fmt: str, required_fields: Tuple[str, ...]):
+    #режет поток байт на пачки строк: (заголовок CSV, строки, номер первой строки, ошибки строк не в UTF-8)
+    header = None
+    row_num = 1
+    tail = b""
+    lines: List[str] = []
+    first_row = row_num
+    bad_rows: List[Dict] = []
+
+    async def raw_lines():
+        nonlocal tail
+        async for chunk in body:
+            tail += chunk
+            *complete, tail = tail.split(b"\n")
+            for line in complete:
+                yield line
+            # тело может прийти из буфера без ожидания сети - отдаем управление циклу
+            await asyncio.sleep(0)
+        if tail:
+            yield tail
+
+    async for raw in raw_lines():
+        try:
+            line = raw.decode("utf-8-sig" if header is None and row_num == 1 else "utf-8").rstrip("\r")
+        except UnicodeDecodeError as e:
+            if fmt == "csv" and header is None:
+                raise ImportFormatError(f"Заголовок CSV не в кодировке UTF-8: {e}")
+            bad_rows.append({"row": row_num, "errors": [f"Строка не в кодировке UTF-8: {e}"]})
+            line = ""
+        if line.strip() == "":
+            # номера строк в пачке идут подряд, поэтому на пропуске пачка закрывается
+            if lines:
+                yield header, lines, first_row, bad_rows
+                lines, bad_rows = [], []
+            row_num += 1
+            continue
+        if fmt == "csv" and header is None:
+            header = [name.strip() for name in next(csv.reader([line]))]
+            missing = [field for field in required_fields if field not in header]
+            if missing:
+                raise ImportFormatError(f"В заголовке CSV нет полей: {', '.join(missing)}")
+            row_num += 1
+            first_row = row_num
+            continue
+        if not lines:
+            first_row = row_num
+        lines.append(line)
+        row_num += 1
+        if len(lines) >= IMPORT_CHUNK_SIZE:
+            yield header, lines, first_row, bad_rows
+            lines, bad_rows = [], []
+    if lines or bad_rows:
+        yield header, lines, first_row, bad_rows
+
+
+async def _validate_stream(body: AsyncIterator[bytes], fmt: str, required_fields: Tuple[str, ...], validate_chunk, *args):
+    #прогоняет пачки через пул, сохраняя порядок строк
+    pool = _get_pool()
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    max_pending = max(IMPORT_WORKERS, 1) * 2
+
+    async for header, lines, first_row, bad_rows in _iter_chunks(body, fmt, required_fields):
+        if bad_rows:
+            yield [], bad_rows
+        if not lines:
+            continue
+        if pool is None:
+            yield validate_chunk(fmt, header, lines, first_row, *args)
+            continue
+        pending.append(loop.run_in_executor(pool, validate_chunk, fmt, header, lines, first_row, *args))
+        if len(pending) >= max_pending:
+            yield await pending.popleft()
+    while pending:
+        yield await pending.popleft()
+
+
+def _free_ids(taken: Set[int], count: int) -> List[int]:
+    #выдает count свободных шестизначных id (меньше, если свободных не хватает)
+    if count <= 1000:
+        result = []
+        attempts = 0
+        while len(result) < count and attempts < count * 20:
+            attempts += 1
+            new_id = services.generate_six_digit_id(str(attempts))
+            if new_id not in taken:
+                taken.add(new_id)
+                result.append(new_id)
+        if len(result) == count:
+            return result
+        count -= len(result)
+    else:
+        result = []
+    free = [i for i in range(100000, 1000000) if i not in taken]
+    picked = random.sample(free, min(count, len(free)))
+    taken.update(picked)
+    return result + picked
+
+
+def _build_items(taken: Set[int], valid: List[Tuple]) -> Tuple[List[Item], List[Dict]]:
+    #выдает id и собирает модели (вызывается в отдельном потоке)
+    ids = _free_ids(taken, len(valid))
+    errors = [
+        {"row": row_num, "errors": [f"Нет свободных id для item: шестизначных id всего {ID_SPACE}"]}
+        for row_num, *_ in valid[len(ids):]
+    ]
+    items = [
+        Item.model_construct(
+            id = item_id,
+            desc = desc,
+            hourly_price = hourly_price,
+            is_available_now = True,
+            current_pickup_point_id = pickup_point_id,
+            reserved_until = None
+        )
+        for item_id, (row_num, desc, hourly_price, pickup_point_id) in zip(ids, valid)
+    ]
+    return items, errors
+
+
+def _build_clients(taken: Set[int], valid: List[Tuple]) -> Tuple[List[Client], List[Dict]]:
+    ids = _free_ids(taken, len(valid))
+    errors = [
+        {"row": row_num, "errors": [f"Нет свободных id для client: шестизначных id всего {ID_SPACE}"]}
+        for row_num, *_ in valid[len(ids):]
+    ]
+    clients = [
+        Client.model_construct(id = client_id, name = name, phone = phone, email = email)
+        for client_id, (row_num, name, phone, email) in zip(ids, valid)
+    ]
+    return clients, errors
+
+
+def _gc_paused(func):
+    #на время импорта выключает сборщик мусора: его полные проходы по растущей куче
+    #останавливали цикл событий на сотни мс. Загруженные объекты живут долго,
+    #поэтому после импорта они переносятся в постоянное поколение (gc.freeze)
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        global _gc_pauses, _gc_was_enabled
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _gc_pauses -= 1
+            if _gc_pauses == 0:
+                gc.freeze()
+                if _gc_was_enabled:
+                    gc.enable()
+    return wrapper
+
+
+def _report(imported: int, errors: List[Dict], max_errors: int) -> Dict:
+    errors.sort(key=lambda e: e["row"])
+    return {
+        "imported": imported,
+        "failed": len(errors),
+        "errors": errors[:max_errors],
+        "errors_truncated": len(errors) > max_errors
+    }
+
+
+@_gc_paused
+async def import_items(body: AsyncIterator[bytes], fmt: str, dry_run: bool = False, max_errors: int = 1000) -> Dict:
+    #импорт вещей, возвращает отчет по строкам
+    pickup_point_ids = set(p.id for p in services.pickup_points_db)
+    valid = []
+    errors = []
+    async for chunk_valid, chunk_errors in _validate_stream(body, fmt, ITEM_FIELDS, validate_items_chunk, pickup_point_ids):
+        valid.extend(chunk_valid)
+        errors.extend(chunk_errors)
+
+    # в шардированном режиме items_db этого процесса неполный - id берем у шардов
+    taken = await services.item_ids()
+    items, id_errors = await asyncio.to_thread(_build_items, taken, valid)
+    errors.extend(id_errors)
+    if not dry_run:
+        items = await services.add_items(items)
+    print(f"[IMPORT] Вещей загружено: {len(items)}, ошибок: {len(errors)}")
+    return _report(len(items), errors, max_errors)
+
+
+@_gc_paused
+async def import_clients(body: AsyncIterator[bytes], fmt: str, dry_run: bool = False, max_errors: int = 1000) -> Dict:
+    #импорт клиентов, возвращает отчет по строкам
+    valid = []
+    errors = []
+    async for chunk_valid, chunk_errors in _validate_stream(body, fmt, CLIENT_FIELDS, validate_clients_chunk):
+        errors.extend(chunk_errors)
+        valid.extend(chunk_valid)
+
+    clients, register_errors = await register_clients(valid, dry_run)
+    errors.extend(register_errors)
+    print(f"[IMPORT] Клиентов загружено: {len(clients)}, ошибок: {len(errors)}")
+    return _report(len(clients), errors, max_errors)
+
+
+def _check_clients(rows: List[Tuple], phones: Set[str], emails: Set[str], taken: Set[int]):
+    #уникальность phone и email по порядку строк (первая строка выигрывает) и выдача id;
+    #возвращает (строки, клиенты по ним, ошибки), вызывается в отдельном потоке
+    valid = []
+    errors = []
+    for row_num, name, phone, email in rows:
+        row_errors = []
+        if phone in phones:
+            row_errors.append(f"В базе уже есть клиент с phone {phone}")
+        if email in emails:
+            row_errors.append(f"В базе уже есть клиент с email {email}")
+        if row_errors:
+            errors.append({"row": row_num, "errors": row_errors})
+            continue
+        phones.add(phone)
+        emails.add(email)
+        valid.append((row_num, name, phone, email))
+    clients, id_errors = _build_clients(taken, valid)
+    return valid, clients, errors + id_errors
+
+
+async def register_clients(rows: List[Tuple], dry_run: bool = False) -> Tuple[List[Client], List[Dict]]:
+    #регистрирует проверенные строки (номер, name, phone, email), возвращает клиентов и ошибки строк;
+    #в шардированном режиме клиентами владеет шард 0, и все делает он
+    if sharding.enabled():
+        return await services.register_clients_in_shard(rows, dry_run)
+
+    phones = set(c.phone for c in services.clients_db)
+    emails = set(c.email for c in services.clients_db)
+    taken = set(client.id for client in services.clients_db)
+    clients_before = len(services.clients_db)
+    valid, clients, errors = await asyncio.to_thread(_check_clients, rows, phones, emails, taken)
+
+    # пока шла проверка, клиентов могли зарегистрировать через /api/new_clients
+    added_meanwhile = services.clients_db[clients_before:]
+    if added_meanwhile:
+        new_phones = set(c.phone for c in added_meanwhile)
+        new_emails = set(c.email for c in added_meanwhile)
+        new_ids = set(c.id for c in added_meanwhile)
+        still_valid = []
+        for (row_num, *_), client in zip(valid, clients):
+            if client.phone in new_phones or client.email in new_emails or client.id in new_ids:
+                errors.append({"row": row_num, "errors": [f"Клиент с phone {client.phone} или email {client.email} зарегистрирован во время импорта"]})
+            else:
+                still_valid.append(client)
+        clients = still_valid
+
+    if not dry_run:
+        await services.add_clients(clients)
+    return clients, errors
@@ -0,0 +1,265 @@
+"""
+Компактное бинарное кодирование RentalOrderMessage для Kafka.
+
+Формат версии 1 (big-endian, 29 байт):
+    B  версия схемы (1)
+    B  флаги: бит 0 - timestamp был с часовым поясом (хранится в UTC)
+    I  order_id
+    I  client_id
+    I  item_id
+    I  pickup_point_id
+    H  rental_duration_hours
+    B  код статуса (STATUS_CODES)
+    q  timestamp, микросекунды от 1970-01-01
+Первый байт отличает форматы: версия схемы (1, 2, ...) или '{' для JSON,
+поэтому decode понимает оба формата, а JSON остается запасным вариантом:
+сообщение, которое не помещается в схему (id >= 2**32, аренда > 65535 часов),
+encode_for_kafka отправляет в JSON.
+Новые поля добавляются новой версией схемы; декодер читает все известные версии.
+decode возвращает проверенный RentalOrderMessage, decode_fields - те же поля
+кортежем без pydantic (для потребителей, которым модель не нужна).
+
+Проверка и замер против JSON:
+    python codec.py bench --messages 100000
+"""
+import os
+import sys
+import json
+import time
+import random
+import struct
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Tuple, Union
+from models import OrderStatus, RentalOrderMessage
+
+SCHEMA_VERSION = 1
+CONTENT_TYPES = {"binary": "application/x-rental-order-v1", "json": "application/json"}
+
+# Коды статусов фиксированы навсегда: новые статусы получают новые коды
+STATUS_CODES: Dict[OrderStatus, int] = {
+    OrderStatus.NEW: 1,
+    OrderStatus.AWAITING_PAYMENT: 2,
+    OrderStatus.AWAITING_RECEIPT: 3,
+    OrderStatus.AWAITING_RETURN: 4,
+    OrderStatus.CANCELLED: 5,
+    OrderStatus.RETURNED: 6
+}
+STATUS_BY_CODE = {code: status for status, code in STATUS_CODES.items()}
+
+# Поля сообщения в том порядке, в котором их возвращает decode_fields
+FIELDS = ("order_id", "client_id", "item_id", "pickup_point_id", "rental_duration_hours", "status", "timestamp")
+
+_V1 = struct.Struct("!BBIIIIHBq")
+_FLAG_AWARE = 1
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class CodecError(Exception):
+  #ошибка кодирования/декодирования сообщения
+    pass
+
+
+def check_format(fmt: str) -> str:
+    #проверяет значение KAFKA_MESSAGE_FORMAT
+    if fmt not in CONTENT_TYPES:
+        raise CodecError(f"KAFKA_MESSAGE_FORMAT={fmt!r} не поддерживается, допустимы binary и json")
+    return fmt
+
+
+# Формат сообщений по умолчанию: binary или json (неверное значение - ошибка при старте)
+KAFKA_MESSAGE_FORMAT = check_format(os.getenv("KAFKA_MESSAGE_FORMAT", "binary"))
+
+
+def _timestamp_to_micros(timestamp: datetime):
+    if timestamp.tzinfo is not None:
+        utc = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return (utc - _EPOCH) // _MICROSECOND, _FLAG_AWARE
+    return (timestamp - _EPOCH) // _MICROSECOND, 0
+
+
+def _micros_to_timestamp(micros: int, flags: int) -> datetime:
+    timestamp = _EPOCH + timedelta(microseconds=micros)
+    if flags & _FLAG_AWARE:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def encode_binary(message: RentalOrderMessage) -> bytes:
+    micros, flags = _timestamp_to_micros(message.timestamp)
+    try:
+        return _V1.pack(
+            SCHEMA_VERSION,
+            flags,
+            message.order_id,
+            message.client_id,
+            message.item_id,
+            message.pickup_point_id,
+            message.rental_duration_hours,
+            STATUS_CODES[message.status],
+            micros
+        )
+    except (struct.error, KeyError) as e:
+        raise CodecError(f"Сообщение для заказа {message.order_id} не помещается в схему v{SCHEMA_VERSION}: {e}")
+
+
+def _fields_v1(data: bytes) -> Tuple:
+    if len(data) != _V1.size:
+        raise CodecError(f"Длина сообщения v1 должна быть {_V1.size} байт, получено {len(data)}")
+    _, flags, order_id, client_id, item_id, pickup_point_id, hours, status_code, micros = _V1.unpack(data)
+    status = STATUS_BY_CODE.get(status_code)
+    if status is None:
+        raise CodecError(f"Неизвестный код статуса {status_code}")
+    return order_id, client_id, item_id, pickup_point_id, hours, status, _micros_to_timestamp(micros, flags)
+
+
+def _fields_json(data: bytes) -> Tuple:
+    try:
+        raw = json.loads(data)
+        return (
+            int(raw["order_id"]),
+            int(raw["client_id"]),
+            int(raw["item_id"]),
+            int(raw["pickup_point_id"]),
+            int(raw["rental_duration_hours"]),
+            OrderStatus(raw["status"]),
+            datetime.fromisoformat(raw["timestamp"])
+        )
+    except (ValueError, KeyError, TypeError) as e:
+        raise CodecError(f"Некорректное JSON-сообщение: {e!r}")
+
+
+_DECODERS = {1: _fields_v1}
+
+
+def encode(message: RentalOrderMessage, fmt: str = None) -> bytes:
+    #кодирует сообщение в binary (по умолчанию) или json
+    fmt = fmt or KAFKA_MESSAGE_FORMAT
+    if fmt == "binary":
+        return encode_binary(message)
+    elif fmt == "json":
+        return message.model_dump_json().encode("utf-8")
+    raise CodecError(f"Неизвестный формат {fmt}, допустимы binary и json")
+
+
+def encode_for_kafka(message: RentalOrderMessage) -> Tuple[bytes, str]:
+    #кодирует сообщение форматом по умолчанию, возвращает (payload, content-type);
+    #если сообщение не помещается в бинарную схему - отправляем его в JSON
+    try:
+        return encode(message), CONTENT_TYPES[KAFKA_MESSAGE_FORMAT]
+    except CodecError as e:
+        if KAFKA_MESSAGE_FORMAT == "json":
+            raise
+        print(f"[CODEC] {e}, отправляем в JSON")
+        return encode(message, "json"), CONTENT_TYPES["json"]
+
+
+def _as_bytes(data: Union[bytes, bytearray, memoryview]) -> bytes:
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    if not data:
+        raise CodecError("Пустое сообщение")
+    return data
+
+
+def decode_fields(data: Union[bytes, bytearray, memoryview]) -> Tuple:
+    #поля сообщения любого формата кортежем в порядке FIELDS, без модели pydantic
+    data = _as_bytes(data)
+    if data[0] == ord("{"):
+        return _fields_json(data)
+    decoder = _DECODERS.get(data[0])
+    if decoder is None:
+        raise CodecError(f"Неизвестная версия схемы {data[0]}")
+    return decoder(data)
+
+
+def decode(data: Union[bytes, bytearray, memoryview]) -> RentalOrderMessage:
+    #декодирует сообщение любого поддерживаемого формата
+    data = _as_bytes(data)
+    if data[0] == ord("{"):
+        return RentalOrderMessage.model_validate_json(data)
+    order_id, client_id, item_id, pickup_point_id, hours, status, timestamp = decode_fields(data)
+    # обычный конструктор: на готовых int/enum/datetime он быстрее model_construct
+    return RentalOrderMessage(
+        order_id=order_id,
+        client_id=client_id,
+        item_id=item_id,
+        pickup_point_id=pickup_point_id,
+        rental_duration_hours=hours,
+        status=status,
+        timestamp=timestamp
+    )
+
+
+#### проверка и замер
+
+def random_message(rng: random.Random) -> RentalOrderMessage:
+    timestamp = _EPOCH + timedelta(microseconds=rng.randrange(0, 4_000_000_000 * 1_000_000))
+    if rng.random() < 0.3:
+        offset = rng.choice([-12 * 60, -3 * 60, 0, 3 * 60, 5 * 60 + 30, 5 * 60 + 45, 14 * 60])
+        timestamp = timestamp.replace(tzinfo=timezone(timedelta(minutes=offset)))
+    return RentalOrderMessage(
+        order_id=rng.randrange(1, 2**32),
+        client_id=rng.randrange(1, 2**32),
+        item_id=rng.randrange(1, 2**32),
+        pickup_point_id=rng.randrange(1, 2**32),
+        rental_duration_hours=rng.randrange(1, 721),
+        status=rng.choice(list(OrderStatus)),
+        timestamp=timestamp
+    )
+
+
+def check_round_trip(messages) -> None:
+    #decode(encode(m)) == m и decode_fields(encode(m)) - поля m, для обоих форматов
+    for message in messages:
+        expected = tuple(getattr(message, field) for field in FIELDS)
+        for fmt in ("binary", "json"):
+            data = encode(message, fmt)
+            decoded = decode(data)
+            if decoded.model_dump() != message.model_dump() or decoded.timestamp != message.timestamp:
+                raise CodecError(f"Round-trip {fmt} не совпал: {message!r} -> {decoded!r}")
+            fields = decode_fields(data)
+            if fields != expected:
+                raise CodecError(f"decode_fields {fmt} не совпал: {message!r} -> {fields!r}")
+
+
+def bench(count: int, seed: int) -> None:
+    rng = random.Random(seed)
+    messages = [random_message(rng) for _ in range(count)]
+    check_round_trip(messages)
+    print(f"round-trip OK на {count} случайных сообщениях (seed={seed})")
+
+    print(f"{'format':>7} {'bytes/msg':>10} {'encode msg/s':>13} {'decode msg/s':>13} {'fields msg/s':>13}")
+    for fmt in ("json", "binary"):
+        started = time.perf_counter()
+        encoded = [encode(m, fmt) for m in messages]
+        encode_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for data in encoded:
+            decode(data)
+        decode_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for data in encoded:
+            decode_fields(data)
+        fields_time = time.perf_counter() - started
+        size = sum(len(data) for data in encoded) / count
+        print(f"{fmt:>7} {size:>10.1f} {count / encode_time:>13.0f} {count / decode_time:>13.0f} {count / fields_time:>13.0f}")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Кодек сообщений RentalOrderMessage")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench_parser = sub.add_parser("bench", help="проверка round-trip и замер против JSON")
+    bench_parser.add_argument("--messages", type=int, default=100000)
+    bench_parser.add_argument("--seed", type=int, default=random.randrange(2**32))
+    args = parser.parse_args(argv)
+    try:
+        bench(args.messages, args.seed)
+    except CodecError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
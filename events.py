@@ -0,0 +1,160 @@
+import os
+import json
+import asyncio
+import secrets
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, List, Optional, Set, Tuple
+
+# Лента изменений заказов для SSE.
+# Каждое событие получает возрастающий seq и один раз сериализуется в кадр SSE,
+# дальше кадр раскладывается по буферам подписчиков. Буфер подписчика ограничен:
+# медленный подписчик при переполнении отключается и может переподключиться
+# с Last-Event-ID, пока нужные события еще лежат в истории.
+# id кадра - "<epoch>-<seq>": epoch выбирается заново при каждом старте процесса,
+# поэтому Last-Event-ID от прошлого запуска (seq которого начался с нуля заново)
+# распознается и клиент получает resync вместо молча пропущенных событий.
+# В шардированном режиме события публикуют шарды (listeners пересылают их
+# процессам приложения), а процесс приложения раздает их своим подписчикам.
+
+# Размер буфера одного подписчика
+EVENTS_SUBSCRIBER_BUFFER = int(os.getenv("EVENTS_SUBSCRIBER_BUFFER", "1000"))
+# Сколько последних событий храним для возобновления после переподключения
+EVENTS_HISTORY_SIZE = int(os.getenv("EVENTS_HISTORY_SIZE", "10000"))
+# Как часто шлем комментарий-пинг, чтобы прокси не рвали соединение
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+
+
+class Subscriber:
+    #подписчик ленты: свой ограниченный буфер кадров и флаг отключения
+    def __init__(self, max_buffer: int):
+        self.buffer: Deque[Tuple[int, str]] = deque()
+        self.max_buffer = max_buffer
+        self.wakeup = asyncio.Event()
+        self.dropped = False
+
+    def push(self, seq: int, frame: str) -> bool:
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped = True
+            self.wakeup.set()
+            return False
+        self.buffer.append((seq, frame))
+        self.wakeup.set()
+        return True
+
+
+class Broadcaster:
+    def __init__(self, history_size: int = EVENTS_HISTORY_SIZE, subscriber_buffer: int = EVENTS_SUBSCRIBER_BUFFER):
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        self.history: Deque[Tuple[int, str]] = deque(maxlen=history_size)
+        self.subscribers: Set[Subscriber] = set()
+        self.subscriber_buffer = subscriber_buffer
+        self.dropped_count = 0
+        # функции (event_type, data), которым передается каждое событие
+        self.listeners: List[Callable[[str, dict], None]] = []
+
+    def publish(self, event_type: str, data: dict) -> int:
+        #публикует событие всем подписчикам, возвращает его seq
+        self.seq += 1
+        payload = json.dumps({"seq": self.seq, "type": event_type, **data}, ensure_ascii=False, default=str)
+        frame = f"id: {self.epoch}-{self.seq}\nevent: {event_type}\ndata: {payload}\n\n"
+        self.history.append((self.seq, frame))
+        for listener in self.listeners:
+            listener(event_type, data)
+
+        slow = [sub for sub in self.subscribers if not sub.push(self.seq, frame)]
+        for sub in slow:
+            # медленного подписчика отключаем, дальше он не тормозит публикацию
+            self.subscribers.discard(sub)
+            self.dropped_count += 1
+        return self.seq
+
+    def subscribe(self, last_seq: Optional[int] = None, epoch: Optional[str] = None) -> Tuple[Subscriber, List[Tuple[int, str]], bool, int]:
+        #регистрирует подписчика, возвращает пропущенные события, признак,
+        #что часть пропущенных событий уже вытеснена из истории, и seq, с которого продолжаем
+        sub = Subscriber(self.subscriber_buffer)
+        missed: List[Tuple[int, str]] = []
+        gap = False
+        if last_seq is not None and ((epoch is not None and epoch != self.epoch) or last_seq > self.seq):
+            # seq из другого запуска процесса: что было между ним и рестартом, неизвестно,
+            # поэтому resync и все события текущего запуска с начала
+            last_seq = 0
+            gap = True
+        if last_seq is not None and last_seq < self.seq:
+            missed = [(seq, frame) for seq, frame in self.history if seq > last_seq]
+            oldest = missed[0][0] if missed else self.seq + 1
+            gap = gap or oldest > last_seq + 1
+        self.subscribers.add(sub)
+        return sub, missed, gap, last_seq or 0
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        self.subscribers.discard(sub)
+
+    def restart(self) -> None:
+        #часть событий потеряна (оборвалась подписка на шард): новый epoch и отключение
+        #подписчиков - переподключившись со старым id, они получат resync
+        self.epoch = secrets.token_hex(4)
+        self.history.clear()
+        for sub in self.subscribers:
+            sub.dropped = True
+            sub.wakeup.set()
+        self.dropped_count += len(self.subscribers)
+        self.subscribers.clear()
+
+    def stats(self) -> dict:
+        return {
+            "epoch": self.epoch,
+            "seq": self.seq,
+            "subscribers": len(self.subscribers),
+            "dropped_subscribers": self.dropped_count,
+            "history_size": len(self.history)
+        }
+
+
+broadcaster = Broadcaster()
+
+
+def publish(event_type: str, **data) -> int:
+    return broadcaster.publish(event_type, data)
+
+
+def parse_event_id(value: str) -> Tuple[Optional[str], Optional[int]]:
+    #разбирает Last-Event-ID: "<epoch>-<seq>" или просто seq, (None, None) если не разобрался
+    epoch, _, seq = value.strip().rpartition("-")
+    if not seq.isdigit():
+        return None, None
+    return epoch or None, int(seq)
+
+
+async def stream(last_seq: Optional[int] = None, epoch: Optional[str] = None):
+    #генератор кадров SSE для одного подписчика
+    sub, missed, gap, last_sent = broadcaster.subscribe(last_seq, epoch)
+    try:
+        if gap:
+            # клиент отстал сильнее, чем хранит история, или пришел из прошлого запуска -
+            # ему нужно перечитать /api/get_orders
+            yield f"event: resync\ndata: {json.dumps({'epoch': broadcaster.epoch, 'seq': broadcaster.seq})}\n\n"
+        for seq, frame in missed:
+            last_sent = seq
+            yield frame
+
+        while True:
+            try:
+                await asyncio.wait_for(sub.wakeup.wait(), timeout=EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield f": heartbeat {datetime.now().isoformat()}\n\n"
+                continue
+            sub.wakeup.clear()
+            while sub.buffer:
+                seq, frame = sub.buffer.popleft()
+                if seq <= last_sent:
+                    continue
+                last_sent = seq
+                yield frame
+            if sub.dropped:
+                # сообщаем, с какого seq переподключаться, и закрываем поток
+                yield f"event: overflow\ndata: {json.dumps({'last_seq': last_sent})}\n\n"
+                return
+    finally:
+        broadcaster.unsubscribe(sub)
@@ -1,9 +1,21 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, status, Header, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from models import OrderStatus, CancelReason, Order, Client, Item, Ppoint, OrderCreateRequest, OrderResponse, RentalOrderMessage, ItemCreateRequest, ClientCreateRequest
 import services
+import archive
+import analytics
+import events
+import bulk_import
+import profiling
+import admission
+import traffic
+import search
+import sharding
+import os
+import json
 from datetime import datetime
 import asyncio
-from typing import List
+from typing import List, Optional
 
 app = FastAPI(
     title="Rental Service API",
@@ -13,6 +25,9 @@ app = FastAPI(
     redoc_url="/redoc"
 )
 
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(traffic.TrafficCaptureMiddleware)
+
 @app.post("/api/new_orders",
           response_model=OrderResponse,
           status_code=status.HTTP_201_CREATED,
@@ -20,44 +35,46 @@ app = FastAPI(
           tags=["Orders"])
 
 async def create_order(order_request: OrderCreateRequest):
-#def create_order(order_request: OrderCreateRequest):
     """
     Создает новый заказ на аренду вещи.
     
     Логика:
+    0. Контроль допуска: при перегрузке 503, при превышении лимита клиента 429 (с Retry-After)
     1. Создает заказ со статусом NEW
     2. Проверяет доступность вещи
     3. Если доступна - обновляет статус на AWAITING_PAYMENT и отправляет в Kafka
     4. Если недоступна - отменяет заказ и отправляет SMS
     """
     try:
-        print(f"Получен запрос на создание заказа: {order_request}")
-        
-        # 1. Создание заказа в БД со статусом NEW
-        new_order = await services.create_order_in_db(order_request)
-        #new_order = create_order_in_db(order_request)
-        print(f"Заказ {new_order} создан")
-        
-        # 2. Проверка возможности выдачи вещи
-        await services.check_item_availability(
-        #check_item_availability(
-            order_request.item_id,
-            order_request.pickup_point_id
-        )
-        print(f"Проверка доступности пройдена для заказа {new_order}")
-        
-        # 3. Бронируем вещь
-        await services.reserve_item(
-        #reserve_item(
-            order_request.item_id,
-            new_order,
-            order_request.rental_duration_hours
+        started = admission.controller.admit(order_request.client_id)
+    except admission.AdmissionRejected as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=e.reason,
+            headers={"Retry-After": str(e.retry_after)}
         )
+
+    result = None
+    try:
+        result = await process_order(order_request)
+        return result
+    finally:
+        # в задержку для лимита идут только успешные заказы: отмена ждет SMS внутри запроса
+        admission.controller.release(started, sample=isinstance(result, Order))
+
+@app.on_event("startup")
+async def start_admission_monitor():
+    asyncio.create_task(admission.controller.monitor_queue_delay())
+
+async def process_order(order_request: OrderCreateRequest):
+#def create_order(order_request: OrderCreateRequest):
+    try:
+        print(f"Получен запрос на создание заказа: {order_request}")
         
-        # 4. Обновляем статус заказа на AWAITING_PAYMENT
-        updated_order = await services.update_order_status(new_order, OrderStatus.AWAITING_PAYMENT)
-        #updated_order = update_order_status(new_order, OrderStatus.AWAITING_PAYMENT)
-        print(f"Статус заказа {new_order} обновлен на AWAITING_PAYMENT")
+        # 1-4. Создание заказа со статусом NEW, проверка возможности выдачи вещи, бронь
+        # и статус AWAITING_PAYMENT (в шардированном режиме - одной командой шарду постомата)
+        updated_order = await services.place_order(order_request)
+        print(f"Заказ {updated_order.id} создан и ожидает оплаты")
 
         #НУЖНО РАСКОМЕНТИТЬ
         # 5. Подготовка и отправка сообщения в Kafka для сервиса документов
@@ -72,7 +89,7 @@ async def create_order(order_request: OrderCreateRequest):
         )
         
         # Асинхронная отправка в Kafka (fire and forget)
-        asyncio.create_task(services.send_to_kafka(kafka_message))
+        admission.controller.spawn_background(services.send_to_kafka(kafka_message))
         
         print(f"Заказ {updated_order.id} успешно отправлен в сервис формирования документов")
         return updated_order
@@ -80,6 +97,8 @@ async def create_order(order_request: OrderCreateRequest):
     except (services.ItemNotAvailableError, services.ItemNotInLocationError, services.DatabaseError, services.ItemNotFoundInTable, services.ItemNotFoundError) as e:
     #except (ItemNotAvailableError, ItemNotInLocationError, DatabaseError, ItemNotFoundInTable, ItemNotFoundError) as e:
         print(f"Ошибка: {e}")
+        # заказ уже создан, если ошибка в проверке или брони вещи
+        new_order = getattr(e, 'order_id', None)
         
         # Определяем причину отмены
         if isinstance(e, services.DatabaseError):
@@ -99,18 +118,30 @@ async def create_order(order_request: OrderCreateRequest):
             cancel_reason = CancelReason.ITEM_NOT_IN_LOCATION
         else:
             cancel_reason = CancelReason.OTHER
+
+        # Если вещь есть, но занята или в другом постомате - ищем такую же доступную.
+        # Вещь из другого постомата сама по себе тоже вариант: ее постомат попадает в группы
+        alternatives = []
+        if cancel_reason in (CancelReason.ITEM_NOT_AVAILABLE, CancelReason.ITEM_NOT_IN_LOCATION):
+            alternatives = await services.find_alternatives(
+                order_request.item_id,
+                order_request.pickup_point_id,
+                include_self=cancel_reason == CancelReason.ITEM_NOT_IN_LOCATION
+            )
         
         # Отмена во время создания заказа
         await services.cancel_order(
         #cancel_order(
             order_request.client_id,
             new_order,
-            cancel_reason
+            cancel_reason,
+            str(e),
+            alternatives
         )
         
-        raise HTTPException(
+        return JSONResponse(
             status_code=status.HTTP_409_CONFLICT,
-            detail=str(e)
+            content={"detail": str(e), "alternatives": alternatives}
         )
 
     except Exception as e:
@@ -131,13 +162,78 @@ async def root():
 
 @app.get("/api/get_items")
 async def get_items():
-    #Возвращает все items_db
-    return services.items_db
+    #Возвращает все items_db (в шардированном режиме - со всех шардов)
+    return await services.get_items()
 
 @app.get("/api/get_orders")
-async def get_orders():
-    #Возвращает все orders_db
-    return services.orders_db
+async def get_orders(include_archived: bool = True):
+    #Возвращает все orders_db, по умолчанию вместе с архивом
+    if sharding.enabled():
+        async def stream_shards():
+            # заказы каждого шарда приходят пачками, целиком в памяти их не держим
+            yield "["
+            first = True
+            async for part in services.iter_orders(include_archived):
+                for order in part:
+                    yield ("" if first else ",") + json.dumps(order, ensure_ascii=False)
+                    first = False
+            yield "]"
+
+        return StreamingResponse(stream_shards(), media_type="application/json")
+
+    if not include_archived or archive.segments_count() == 0:
+        return services.orders_db
+
+    def stream_orders():
+        # архив отдаем потоково, чтобы не поднимать его целиком в память
+        yield "["
+        first = True
+        for order in list(services.orders_db):
+            yield ("" if first else ",") + order.model_dump_json()
+            first = False
+        for order in archive.iter_orders():
+            yield ("" if first else ",") + order.model_dump_json()
+            first = False
+        yield "]"
+
+    return StreamingResponse(stream_orders(), media_type="application/json")
+
+@app.get("/api/get_orders/{order_id}",
+         response_model=Order,
+         summary="Получить заказ по id (включая архив)",
+         tags=["Orders"])
+async def get_order(order_id: int):
+    try:
+        return await services.get_order(order_id)
+    except services.ItemNotFoundError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+
+# Как часто фоновая задача переносит завершенные заказы в архив (0 - не запускать)
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+async def archive_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+        try:
+            await services.archive_finished_orders()
+        except Exception as e:
+            print(f"[ARCHIVE] Ошибка архивации: {e}")
+
+@app.on_event("startup")
+async def start_archive_loop():
+    if ARCHIVE_INTERVAL_SECONDS > 0:
+        asyncio.create_task(archive_loop())
+
+@app.post("/api/archive_orders", tags=["Orders"])
+async def archive_orders(min_age_hours: float = None):
+    """
+    Переносит завершенные заказы (CANCELLED, RETURNED) старше min_age_hours в архив.
+    """
+    archived = await services.archive_finished_orders(min_age_hours)
+    return {"archived_count": archived, **await services.storage_counts()}
 
 if __name__ == "__main__":
     import uvicorn
@@ -151,7 +247,12 @@ async def reset_database():
     """
     import services
     import importlib
+    if sharding.enabled():
+        await services.reset_shards()  # Данные в шардах - сбрасывает каждый шард
+        return {"message": "Database reset successfully", **await services.storage_counts()}
     importlib.reload(services)  # Перезагружаем модуль services
+    archive.clear()  # Удаляем сегменты архива
+    services.rebuild_analytics(replace=True)  # Пересчитываем агрегаты по новой базе
     
     print("База данных сброшена к начальному состоянию")
     return {"message": "Database reset successfully", "orders_count": len(services.orders_db)}
@@ -178,10 +279,8 @@ async def add_new_items(request_data: ItemCreateRequest):
 
     # Генерируем и проверяем id в базе
     while True:
-        try:
-          item_id = services.generate_six_digit_id('items_db')
-          num_conflict = services.find_in_db_by_attribute('items_db', item_id)
-        except(services.ItemNotFoundInTable):
+        item_id = services.generate_six_digit_id('items_db')
+        if not await services.item_id_taken(item_id):
           break
     
     # Проверяем current_pickup_point_id в базе
@@ -230,7 +329,7 @@ async def add_new_items(request_data: ItemCreateRequest):
         )
     
     try:
-        await services.add_item(item_obj)
+        item_obj = await services.add_item(item_obj)
 
     except Exception as e:
         print(f"Непредвиденная ошибка: {e}")
@@ -263,6 +362,24 @@ async def create_new_client(request_data: ClientCreateRequest):
     # 5. Регистрируем в базе
 
 
+    if sharding.enabled():
+      # клиентами владеет шард 0: проверки и регистрация - там
+      if request_data.name == '' or request_data.phone == '' or request_data.email == '':
+        raise HTTPException(
+              status_code=status.HTTP_409_CONFLICT,
+              detail=f"Нельзя зарегистрировать client без полей name, email, phone"
+          )
+      try:
+        clients, errors = await bulk_import.register_clients([(1, request_data.name, request_data.phone, request_data.email)])
+      except services.DatabaseError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+      if errors:
+        raise HTTPException(
+              status_code=status.HTTP_409_CONFLICT,
+              detail="; ".join(errors[0]["errors"])
+          )
+      return clients[0]
+
     # Генерируем и проверяем id в базе
     while True:
         try:
@@ -327,3 +444,261 @@ async def create_new_client(request_data: ClientCreateRequest):
         )
 
     return client_obj
+
+
+@app.get("/api/analytics",
+         summary="Агрегаты по вещам и постоматам",
+         tags=["Analytics"])
+async def get_analytics(mode: str = "incremental"):
+    """
+    Возвращает счетчики по вещам и постоматам: активные аренды, отмены по причинам,
+    забронированные часы и выручку.
+
+    mode:
+    - incremental - материализованные агрегаты, без прохода по orders_db
+    - rebuild - пересчет с нуля по orders_db и архиву (для проверки)
+    """
+    if mode in ("incremental", "rebuild"):
+        return await services.get_analytics(rebuild=mode == "rebuild")
+    raise HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail=f"Неизвестный mode {mode}, допустимы incremental и rebuild"
+    )
+
+@app.get("/api/analytics/items/{item_id}", tags=["Analytics"])
+async def get_item_analytics(item_id: int):
+    return await services.get_item_analytics(item_id)
+
+@app.get("/api/analytics/pickup_points/{pickup_point_id}", tags=["Analytics"])
+async def get_pickup_point_analytics(pickup_point_id: int):
+    return await services.get_pickup_point_analytics(pickup_point_id)
+
+
+@app.get("/api/orders/events",
+         summary="Лента изменений заказов (Server-Sent Events)",
+         tags=["Orders"])
+async def order_events(since: Optional[int] = None, last_event_id: Optional[str] = Header(default=None)):
+    """
+    Отдает поток событий по заказам вместо опроса /api/get_orders:
+    order_created, item_reserved, order_status_changed, order_cancelled.
+
+    После переподключения клиент передает id последнего события ("<epoch>-<seq>")
+    в заголовке Last-Event-ID (браузерный EventSource делает это сам) или seq в параметре since.
+    Если события уже вытеснены из истории или id остался от прошлого запуска сервера,
+    приходит событие resync.
+    Если клиент не успевает читать, приходит событие overflow и поток закрывается.
+    """
+    if sharding.enabled():
+        # события публикуют шарды, этот процесс пересылает их своим подписчикам
+        sharding.start_event_feeds()
+
+    last_seq, epoch = since, None
+    if last_event_id is not None:
+        parsed_epoch, parsed_seq = events.parse_event_id(last_event_id)
+        if parsed_seq is not None:
+            last_seq, epoch = parsed_seq, parsed_epoch
+
+    return StreamingResponse(
+        events.stream(last_seq, epoch),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/orders/events/stats", tags=["Orders"])
+async def order_events_stats():
+    return events.broadcaster.stats()
+
+
+def _import_format(request: Request, format: Optional[str]) -> str:
+    #формат загрузки: параметр format или Content-Type
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        if "csv" in content_type:
+            format = "csv"
+        elif "ndjson" in content_type or "jsonl" in content_type or "json" in content_type:
+            format = "ndjson"
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Поддерживаются только CSV (text/csv) и NDJSON (application/x-ndjson)"
+        )
+    return format
+
+@app.post("/api/import/items",
+          summary="Массовый импорт вещей из CSV/NDJSON",
+          tags=["Items"])
+async def import_items(request: Request, format: Optional[str] = None, dry_run: bool = False, max_errors: int = 1000):
+    """
+    Загружает вещи из тела запроса (CSV с заголовком desc,hourly_price,current_pickup_point_id
+    или NDJSON с теми же полями). Строки с ошибками пропускаются и попадают в отчет.
+    """
+    fmt = _import_format(request, format)
+    try:
+        return await bulk_import.import_items(request.stream(), fmt, dry_run, max_errors)
+    except bulk_import.ImportFormatError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e)
+        )
+
+@app.post("/api/import/clients",
+          summary="Массовый импорт клиентов из CSV/NDJSON",
+          tags=["Clients"])
+async def import_clients(request: Request, format: Optional[str] = None, dry_run: bool = False, max_errors: int = 1000):
+    """
+    Загружает клиентов из тела запроса (CSV с заголовком name,phone,email
+    или NDJSON с теми же полями). Строки с ошибками пропускаются и попадают в отчет.
+    """
+    fmt = _import_format(request, format)
+    try:
+        return await bulk_import.import_clients(request.stream(), fmt, dry_run, max_errors)
+    except bulk_import.ImportFormatError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e)
+        )
+
+
+@app.get("/api/admin/profiling", tags=["Admin"])
+async def get_profiling():
+    """
+    Настройки профилирования, сводка времени по стадиям services
+    для сэмплированных запросов и список захваченных медленных запросов.
+    """
+    return {
+        "config": profiling.config.as_dict(),
+        "stages": profiling.get_stage_stats(),
+        "captures": profiling.list_captures()
+    }
+
+@app.post("/api/admin/profiling", tags=["Admin"])
+async def configure_profiling(enabled: Optional[bool] = None, sample_rate: Optional[float] = None, slow_ms: Optional[float] = None,
+                              stack_sampling_ms: Optional[float] = None, buffer_size: Optional[int] = None, reset: bool = False):
+    #Включает/выключает профилирование и меняет его параметры на лету
+    if reset:
+        profiling.reset()
+    return profiling.configure(enabled, sample_rate, slow_ms, stack_sampling_ms, buffer_size)
+
+@app.get("/api/admin/profiling/flamegraph",
+         response_class=PlainTextResponse,
+         tags=["Admin"])
+async def get_profiling_flamegraph(kind: str = "wall", capture_id: Optional[int] = None):
+    """
+    Захваты медленных запросов в формате folded stacks (flamegraph.pl, speedscope).
+
+    kind:
+    - wall - дерево вызовов services, вес - собственное время в микросекундах
+    - cpu - сэмплы стеков, вес - число сэмплов (нужен stack_sampling_ms > 0)
+    """
+    if kind not in ("wall", "cpu"):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Неизвестный kind {kind}, допустимы wall и cpu"
+        )
+    if capture_id is not None and profiling.get_capture(capture_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Захват {capture_id} не найден"
+        )
+    return profiling.folded(kind, capture_id)
+
+
+@app.get("/api/admin/admission", tags=["Admin"])
+async def get_admission():
+    #Текущий лимит, задержки и счетчики отказов контроля допуска POST /api/new_orders
+    return admission.controller.stats()
+
+@app.post("/api/admin/admission", tags=["Admin"])
+async def configure_admission(enabled: Optional[bool] = None, min_limit: Optional[float] = None, max_limit: Optional[float] = None,
+                              latency_tolerance: Optional[float] = None, target_latency_ms: Optional[float] = None,
+                              max_queue_delay_ms: Optional[float] = None,
+                              client_rate: Optional[float] = None, client_burst: Optional[float] = None,
+                              max_background_tasks: Optional[int] = None):
+    #Меняет настройки контроля допуска на лету
+    return admission.controller.configure(
+        enabled=enabled,
+        min_limit=min_limit,
+        max_limit=max_limit,
+        latency_tolerance=latency_tolerance,
+        target_latency_ms=target_latency_ms,
+        max_queue_delay_ms=max_queue_delay_ms,
+        client_rate=client_rate,
+        client_burst=client_burst,
+        max_background_tasks=max_background_tasks
+    )
+
+
+@app.get("/api/admin/traffic_capture", tags=["Admin"])
+async def get_traffic_capture():
+    return traffic.recorder.status()
+
+@app.post("/api/admin/traffic_capture", tags=["Admin"])
+async def configure_traffic_capture(enabled: bool, anonymize: bool = False, paths: Optional[str] = None):
+    """
+    Включает или выключает запись трафика в JSONL-трассу для replay.py.
+    Файл трассы задается переменной TRAFFIC_CAPTURE_FILE, при включении
+    первой строкой в него пишется снимок таблиц services.
+
+    paths - список префиксов через запятую (по умолчанию TRAFFIC_CAPTURE_PATHS).
+    """
+    if not enabled:
+        return traffic.recorder.stop()
+    capture_paths = tuple(p for p in paths.split(",") if p) if paths else None
+    return traffic.recorder.start(await services.snapshot_tables(), None, anonymize, capture_paths)
+
+
+@app.get("/api/items/search",
+         summary="Поиск вещей по описанию",
+         tags=["Items"])
+async def search_items(q: str, available_only: bool = True, pickup_point_id: Optional[int] = None, limit: int = 20):
+    """
+    Ищет вещи, в описании которых есть все слова запроса
+    (без учета регистра, ё = е). Полные совпадения описания идут первыми.
+    """
+    return await services.search_items(q, available_only, pickup_point_id, max(1, min(limit, 100)))
+
+
+@app.post("/api/items/{item_id}/move",
+          response_model=Item,
+          summary="Перенести вещь в другой постомат",
+          tags=["Items"])
+async def move_item(item_id: int, pickup_point_id: int):
+    #Переносит свободную вещь; в шардированном режиме - в том числе между шардами
+    try:
+        return await services.move_item(item_id, pickup_point_id)
+    except (services.ItemNotFoundError, services.PPointNotFound) as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except services.ItemNotAvailableError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
+    except services.DatabaseError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+
+@app.on_event("startup")
+async def start_sharded_mode():
+    # данные в шардах, процессов приложения может быть несколько
+    if sharding.enabled():
+        print(f"[SHARDS] Шардов: {sharding.SHARDS}, процесс приложения {os.getpid()}")
+
+@app.on_event("shutdown")
+async def stop_sharded_mode():
+    await sharding.stop_event_feeds()
+
+@app.on_event("startup")
+async def load_analytics():
+    await services.load_analytics()
+
+@app.get("/api/admin/shards", tags=["Admin"])
+async def get_shards():
+    #Состояние шардов инвентаря
+    if not sharding.enabled():
+        return {"shards": 0}
+    return {"shards": sharding.SHARDS, "stats": await sharding.router.stats()}
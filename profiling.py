@@ -0,0 +1,277 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+import functools
+from collections import deque, Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Профилирование запросов по требованию.
+# Пока профилирование выключено, middleware сразу передает запрос дальше,
+# а обертка timed делает только одну проверку ContextVar.
+# Включенное профилирование:
+# - для каждого запроса строит дерево вызовов функций services (время по стене);
+# - для доли PROFILING_SAMPLE_RATE запросов копит сводку времени по стадиям;
+# - запросы дольше PROFILING_SLOW_MS целиком кладет в кольцевой буфер;
+# - если PROFILING_STACK_SAMPLING_MS > 0, фоновый поток снимает стеки
+#   основного потока и приписывает их запросу, который сейчас выполняется.
+# Захваты отдаются в формате folded stacks (flamegraph.pl, speedscope, inferno).
+
+
+def _env_bool(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+class ProfilingConfig:
+    def __init__(self):
+        self.enabled = _env_bool("PROFILING_ENABLED", "false")
+        # Доля запросов, попадающих в сводку по стадиям
+        self.sample_rate = float(os.getenv("PROFILING_SAMPLE_RATE", "0.01"))
+        # Порог медленного запроса, мс
+        self.slow_ms = float(os.getenv("PROFILING_SLOW_MS", "500"))
+        # Интервал снятия стеков, мс (0 - не снимать)
+        self.stack_sampling_ms = float(os.getenv("PROFILING_STACK_SAMPLING_MS", "0"))
+        # Сколько медленных запросов хранить
+        self.buffer_size = int(os.getenv("PROFILING_BUFFER_SIZE", "100"))
+
+    def as_dict(self) -> Dict:
+        return dict(self.__dict__)
+
+
+class Capture:
+    #данные профилирования одного запроса
+    def __init__(self, name: str, sampled: bool):
+        self.name = name
+        self.sampled = sampled
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.status_code = None
+        self.finished = False
+        # (путь стадии, длительность в секундах)
+        self.stages: List[Tuple[Tuple[str, ...], float]] = []
+        # свернутый стек -> число снятых сэмплов
+        self.stack_samples: Counter = Counter()
+
+    def record(self, path: Tuple[str, ...], duration: float) -> None:
+        # fire-and-forget задачи (send_to_kafka) могут закончиться после ответа
+        if not self.finished:
+            self.stages.append((path, duration))
+
+    def wall_folded(self) -> str:
+        #folded stacks по времени стадий, вес - собственное время в микросекундах
+        inclusive: Dict[Tuple[str, ...], float] = {(): self.duration}
+        for path, duration in self.stages:
+            inclusive[path] = inclusive.get(path, 0.0) + duration
+        children: Dict[Tuple[str, ...], float] = {}
+        for path, duration in inclusive.items():
+            if path:
+                children[path[:-1]] = children.get(path[:-1], 0.0) + duration
+        lines = []
+        for path, duration in inclusive.items():
+            self_time = max(duration - children.get(path, 0.0), 0.0)
+            weight = int(self_time * 1_000_000)
+            if weight > 0:
+                lines.append(";".join((self.name,) + path) + f" {weight}")
+        return "\n".join(lines) + "\n"
+
+    def cpu_folded(self) -> str:
+        #folded stacks по сэмплам стеков, вес - число сэмплов
+        return "".join(f"{self.name};{stack} {count}\n" for stack, count in self.stack_samples.items())
+
+    def summary(self, capture_id: int) -> Dict:
+        return {
+            "id": capture_id,
+            "request": self.name,
+            "status_code": self.status_code,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration * 1000, 3),
+            "stages": len(self.stages),
+            "stack_samples": sum(self.stack_samples.values())
+        }
+
+
+config = ProfilingConfig()
+captures: Deque[Tuple[int, Capture]] = deque(maxlen=config.buffer_size)
+# сводка по стадиям для сэмплированных запросов: имя -> [число вызовов, сумма, максимум]
+stage_stats: Dict[str, List[float]] = {}
+_capture_seq = 0
+_current: ContextVar[Optional[Capture]] = ContextVar("profiling_capture", default=None)
+_path: ContextVar[Tuple[str, ...]] = ContextVar("profiling_path", default=())
+
+# кадры ProfilingMiddleware.__call__ выполняющихся запросов -> их Capture
+_inflight: Dict[int, Capture] = {}
+_main_thread_id: Optional[int] = None
+_sampler: Optional[threading.Thread] = None
+
+
+def timed(func):
+    #замеряет время вызова функции services внутри профилируемого запроса
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            capture = _current.get()
+            if capture is None:
+                return await func(*args, **kwargs)
+            path = _path.get() + (name,)
+            token = _path.set(path)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                capture.record(path, time.perf_counter() - start)
+                _path.reset(token)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        capture = _current.get()
+        if capture is None:
+            return func(*args, **kwargs)
+        path = _path.get() + (name,)
+        token = _path.set(path)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            capture.record(path, time.perf_counter() - start)
+            _path.reset(token)
+    return wrapper
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _sampler_loop() -> None:
+    #фоновый поток: снимает стек основного потока и приписывает его запросу
+    while config.enabled and config.stack_sampling_ms > 0:
+        time.sleep(config.stack_sampling_ms / 1000)
+        frame = sys._current_frames().get(_main_thread_id)
+        stack = []
+        while frame is not None:
+            capture = _inflight.get(id(frame))
+            if capture is not None:
+                if stack and not capture.finished:
+                    capture.stack_samples[";".join(reversed(stack))] += 1
+                break
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+
+
+def _ensure_sampler() -> None:
+    global _sampler
+    if config.enabled and config.stack_sampling_ms > 0 and (_sampler is None or not _sampler.is_alive()):
+        _sampler = threading.Thread(target=_sampler_loop, name="profiling-sampler", daemon=True)
+        _sampler.start()
+
+
+def configure(enabled: Optional[bool] = None, sample_rate: Optional[float] = None, slow_ms: Optional[float] = None,
+              stack_sampling_ms: Optional[float] = None, buffer_size: Optional[int] = None) -> Dict:
+    #меняет настройки профилирования на лету
+    global captures
+    if enabled is not None:
+        config.enabled = enabled
+    if sample_rate is not None:
+        config.sample_rate = min(max(sample_rate, 0.0), 1.0)
+    if slow_ms is not None:
+        config.slow_ms = slow_ms
+    if stack_sampling_ms is not None:
+        config.stack_sampling_ms = stack_sampling_ms
+    if buffer_size is not None and buffer_size != config.buffer_size:
+        config.buffer_size = buffer_size
+        captures = deque(captures, maxlen=buffer_size)
+    if _main_thread_id is not None:
+        _ensure_sampler()
+    return config.as_dict()
+
+
+def _finish(capture: Capture) -> None:
+    global _capture_seq
+    capture.finished = True
+    if capture.sampled:
+        for path, duration in capture.stages:
+            stats = stage_stats.setdefault(path[-1], [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+    if capture.duration * 1000 >= config.slow_ms:
+        _capture_seq += 1
+        captures.append((_capture_seq, capture))
+
+
+def get_stage_stats() -> Dict:
+    return {
+        name: {
+            "calls": int(calls),
+            "total_ms": round(total * 1000, 3),
+            "avg_ms": round(total / calls * 1000, 3) if calls else 0.0,
+            "max_ms": round(max_time * 1000, 3)
+        }
+        for name, (calls, total, max_time) in stage_stats.items()
+    }
+
+
+def list_captures() -> List[Dict]:
+    return [capture.summary(capture_id) for capture_id, capture in captures]
+
+
+def get_capture(capture_id: int) -> Optional[Capture]:
+    for stored_id, capture in captures:
+        if stored_id == capture_id:
+            return capture
+    return None
+
+
+def folded(kind: str = "wall", capture_id: Optional[int] = None) -> str:
+    #folded stacks одного захвата или всех захватов буфера
+    selected = [c for i, c in captures if capture_id is None or i == capture_id]
+    if kind == "cpu":
+        return "".join(c.cpu_folded() for c in selected)
+    return "".join(c.wall_folded() for c in selected)
+
+
+def reset() -> None:
+    captures.clear()
+    stage_stats.clear()
+
+
+class ProfilingMiddleware:
+    #ASGI middleware: при выключенном профилировании только проверяет флаг
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _main_thread_id
+        if not config.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if _main_thread_id is None:
+            _main_thread_id = threading.get_ident()
+            _ensure_sampler()
+
+        capture = Capture(f"{scope['method']} {scope['path']}", random.random() < config.sample_rate)
+        token = _current.set(capture)
+        frame_id = id(sys._getframe())
+        _inflight[frame_id] = capture
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                capture.status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            capture.duration = time.perf_counter() - capture.start
+            _inflight.pop(frame_id, None)
+            _current.reset(token)
+            _finish(capture)
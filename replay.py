@@ -0,0 +1,261 @@
+"""
+Воспроизведение трассы трафика, записанной traffic.TrafficCaptureMiddleware.
+
+Приложение поднимается в этом же процессе и вызывается напрямую через ASGI
+(без сети), таблицы services загружаются из снимка в начале трассы.
+Запросы отправляются по расписанию трассы (открытая нагрузка), ускоренному в speed раз.
+
+Примеры:
+    python replay.py run traffic.jsonl --speed 10
+    python replay.py run traffic.jsonl --build ../rent_service_api_old --output old.json
+    python replay.py compare traffic.jsonl --build-a ../old --build-b . --speed 20
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from typing import Dict, List, Optional
+
+MIN_SPEED = 1.0
+MAX_SPEED = 50.0
+
+
+def load_trace(path: str):
+    #читает трассу: (снимок таблиц, список запросов по времени)
+    with open(path, "r", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r["t"])
+    return header["snapshot"], records
+
+
+def endpoint_key(method: str, path: str) -> str:
+    templated = re.sub(r"/\d+(?=/|$)", "/{id}", path)
+    return f"{method} {templated}"
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+async def call_app(app, method: str, path: str, query: str, body: Optional[bytes]):
+    #вызывает ASGI-приложение напрямую, возвращает (статус, тело ответа)
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": (query or "").encode(),
+        "root_path": "",
+        "headers": [(b"host", b"replay"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 0),
+        "server": ("replay", 80)
+    }
+    sent = False
+    status_code = 500
+    response_body = []
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body or b"", "more_body": False}
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+        elif message["type"] == "http.response.body":
+            response_body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status_code, b"".join(response_body)
+
+
+async def replay(records: List[Dict], app, speed: float) -> Dict:
+    latencies: Dict[str, List[float]] = {}
+    statuses: Dict[str, Dict[str, int]] = {}
+    # id из трассы -> id, выданный при воспроизведении
+    id_map = {"/api/new_items": {}, "/api/new_clients": {}}
+
+    async def one(record):
+        body = record.get("b")
+        if isinstance(body, dict) and record["p"] == "/api/new_orders":
+            body = dict(body)
+            body["item_id"] = id_map["/api/new_items"].get(body.get("item_id"), body.get("item_id"))
+            body["client_id"] = id_map["/api/new_clients"].get(body.get("client_id"), body.get("client_id"))
+        raw = None
+        if body is not None:
+            raw = (json.dumps(body) if not isinstance(body, str) else body).encode()
+
+        start = time.perf_counter()
+        try:
+            status_code, response = await call_app(app, record["m"], record["p"], record.get("q", ""), raw)
+        except Exception:
+            # исключение прошло через весь ASGI-стек - для клиента это 500, прогон продолжаем
+            status_code, response = 500, b""
+        latency = time.perf_counter() - start
+
+        key = endpoint_key(record["m"], record["p"])
+        latencies.setdefault(key, []).append(latency)
+        statuses.setdefault(key, {})
+        statuses[key][str(status_code)] = statuses[key].get(str(status_code), 0) + 1
+        if "r" in record and status_code == 201:
+            try:
+                id_map[record["p"]][record["r"]] = json.loads(response)["id"]
+            except (ValueError, KeyError):
+                pass
+
+    tasks = []
+    started = time.perf_counter()
+    for record in records:
+        delay = record["t"] / speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(record)))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    duration = time.perf_counter() - started
+
+    all_latencies = [lat for values in latencies.values() for lat in values]
+    return {
+        "speed": speed,
+        "requests": len(records),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(records) / duration, 2) if duration else 0.0,
+        "p50_ms": round(percentile(all_latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(all_latencies, 99) * 1000, 3),
+        "endpoints": {
+            key: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "max_ms": round(max(values) * 1000, 3),
+                "statuses": statuses[key]
+            }
+            for key, values in sorted(latencies.items())
+        }
+    }
+
+
+def load_snapshot(services, snapshot: Dict) -> None:
+    #загружает снимок в таблицы services любой сборки, в том числе без services.load_tables
+    models = sys.modules["models"]
+    tables = {
+        "orders_db": models.Order,
+        "items_db": models.Item,
+        "clients_db": models.Client,
+        "pickup_points_db": models.Ppoint
+    }
+    for name, model in tables.items():
+        getattr(services, name)[:] = [model.model_validate(row) for row in snapshot.get(name, [])]
+    # производные структуры пересобираем, только если они есть в сборке
+    search = sys.modules.get("search")
+    if search is not None and hasattr(search, "rebuild"):
+        search.rebuild(services.items_db)
+    if hasattr(services, "rebuild_analytics"):
+        services.rebuild_analytics(replace=True)
+
+
+def run(trace: str, build: str, speed: float, verbose: bool = False) -> Dict:
+    #воспроизводит трассу на сборке из каталога build
+    build = os.path.abspath(build)
+    # фоновые задачи и запись трафика сборки при воспроизведении не нужны
+    os.environ.setdefault("ARCHIVE_DIR", tempfile.mkdtemp(prefix="replay_archive_"))
+    os.environ.setdefault("ARCHIVE_INTERVAL_SECONDS", "0")
+    sys.path.insert(0, build)
+    snapshot, records = load_trace(trace)
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with output:
+        import main as app_module
+        import services
+        load_snapshot(services, snapshot)
+        result = asyncio.run(replay(records, app_module.app, speed))
+    result["build"] = build
+    return result
+
+
+def print_comparison(a: Dict, b: Dict) -> None:
+    print(f"A: {a['build']}")
+    print(f"B: {b['build']}")
+    print(f"{'endpoint':40} {'count':>7} {'p50 A':>9} {'p50 B':>9} {'p99 A':>9} {'p99 B':>9} {'p99 diff':>9}")
+    for key in sorted(set(a["endpoints"]) | set(b["endpoints"])):
+        ea = a["endpoints"].get(key, {})
+        eb = b["endpoints"].get(key, {})
+        p99a = ea.get("p99_ms", 0.0)
+        p99b = eb.get("p99_ms", 0.0)
+        diff = f"{(p99b - p99a) / p99a * 100:+.1f}%" if p99a else "-"
+        print(f"{key:40} {ea.get('count', eb.get('count', 0)):>7} {ea.get('p50_ms', 0.0):>9} {eb.get('p50_ms', 0.0):>9} {p99a:>9} {p99b:>9} {diff:>9}")
+    for name in ("throughput_rps", "p50_ms", "p99_ms"):
+        diff = f"{(b[name] - a[name]) / a[name] * 100:+.1f}%" if a[name] else "-"
+        print(f"{name:40} {a[name]:>9} -> {b[name]:>9} ({diff})")
+
+
+def _run_subprocess(trace: str, build: str, speed: float) -> Dict:
+    # каждая сборка в отдельном интерпретаторе, чтобы модули не смешивались
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        output = f.name
+    subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "run", trace, "--build", build, "--speed", str(speed), "--output", output],
+        check=True
+    )
+    with open(output, "r", encoding="utf-8") as f:
+        result = json.load(f)
+    os.remove(output)
+    return result
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Воспроизведение трассы трафика rent_service_api")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="воспроизвести трассу на одной сборке")
+    run_parser.add_argument("trace")
+    run_parser.add_argument("--build", default=os.path.dirname(os.path.abspath(__file__)))
+    run_parser.add_argument("--speed", type=float, default=1.0)
+    run_parser.add_argument("--output")
+    run_parser.add_argument("--verbose", action="store_true", help="не глушить вывод приложения")
+
+    compare_parser = sub.add_parser("compare", help="сравнить две сборки на одной трассе")
+    compare_parser.add_argument("trace")
+    compare_parser.add_argument("--build-a", required=True)
+    compare_parser.add_argument("--build-b", required=True)
+    compare_parser.add_argument("--speed", type=float, default=1.0)
+
+    args = parser.parse_args(argv)
+    if not MIN_SPEED <= args.speed <= MAX_SPEED:
+        parser.error(f"--speed должен быть от {MIN_SPEED:g} до {MAX_SPEED:g}")
+
+    if args.command == "run":
+        result = run(args.trace, args.build, args.speed, args.verbose)
+        text = json.dumps(result, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text)
+        else:
+            print(text)
+    else:
+        trace = os.path.abspath(args.trace)
+        a = _run_subprocess(trace, args.build_a, args.speed)
+        b = _run_subprocess(trace, args.build_b, args.speed)
+        print_comparison(a, b)
+
+
+if __name__ == "__main__":
+    main()
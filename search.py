@@ -0,0 +1,274 @@
+import os
+import re
+import time
+import heapq
+import random
+import argparse
+import unicodedata
+from itertools import islice
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+from models import Item
+
+# Инвертированный индекс по Item.desc.
+# Описание нормализуется (NFKC, нижний регистр, ё -> е) и режется на слова.
+# Индекс (_Index) - это postings: слово -> id вещей и exact: набор слов -> id
+# вещей с таким же описанием (для подбора "той же вещи" за O(1)). Кроме индекса
+# по всем вещам держим индекс по доступным сейчас вещам и такие же индексы по
+# каждому постомату, поэтому поиск свободных вещей не перебирает занятые.
+# Индексы обновляются при добавлении и бронировании вещей, полного прохода
+# по items_db нет.
+
+# Сколько вещей максимум просматриваем в одном запросе: столько полных совпадений
+# и столько же частичных. Если совпадений больше, выдача строится по первым
+# просмотренным (при поиске среди занятых вещей с фильтром по постомату
+# подходящих среди них может оказаться мало)
+SEARCH_SCAN_LIMIT = int(os.getenv("SEARCH_SCAN_LIMIT", "256"))
+
+# Сколько альтернатив предлагаем вместо недоступной вещи
+ALTERNATIVES_LIMIT = 10
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class _Index:
+    #слово -> id вещей и набор слов -> id вещей
+    def __init__(self):
+        self.postings: Dict[str, Set[int]] = {}
+        self.exact: Dict[FrozenSet[str], Set[int]] = {}
+
+    def add(self, item_id: int, tokens: FrozenSet[str]) -> None:
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(item_id)
+        self.exact.setdefault(tokens, set()).add(item_id)
+
+    def remove(self, item_id: int, tokens: FrozenSet[str]) -> None:
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.discard(item_id)
+                if not posting:
+                    del self.postings[token]
+        same = self.exact.get(tokens)
+        if same is not None:
+            same.discard(item_id)
+            if not same:
+                del self.exact[tokens]
+
+
+_all = _Index()
+# только доступные сейчас вещи: все и по постоматам
+_available = _Index()
+_available_by_point: Dict[int, _Index] = {}
+# id -> (слова, описание, цена, постомат, доступна ли сейчас)
+_items: Dict[int, Tuple[FrozenSet[str], str, int, int, bool]] = {}
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    return text.replace("ё", "е")
+
+
+def tokenize(text: str) -> FrozenSet[str]:
+    return frozenset(_WORD_RE.findall(normalize(text)))
+
+
+def _remove_available(item_id: int, tokens: FrozenSet[str], ppoint: int) -> None:
+    _available.remove(item_id, tokens)
+    point_index = _available_by_point.get(ppoint)
+    if point_index is not None:
+        point_index.remove(item_id, tokens)
+        if not point_index.exact:
+            del _available_by_point[ppoint]
+
+
+def index_item(item: Item) -> None:
+    #добавляет вещь в индекс или обновляет ее
+    old = _items.get(item.id)
+    tokens = tokenize(item.desc) if old is None or old[1] != item.desc else old[0]
+    if old is None or old[0] != tokens:
+        if old is not None:
+            _all.remove(item.id, old[0])
+        _all.add(item.id, tokens)
+    # в индексах доступных вещей меняем запись, только если сменились слова, постомат или доступность
+    old_available = (old[0], old[3]) if old is not None and old[4] else None
+    new_available = (tokens, item.current_pickup_point_id) if item.is_available_now else None
+    if old_available != new_available:
+        if old_available is not None:
+            _remove_available(item.id, *old_available)
+        if new_available is not None:
+            _available.add(item.id, tokens)
+            _available_by_point.setdefault(item.current_pickup_point_id, _Index()).add(item.id, tokens)
+    _items[item.id] = (tokens, item.desc, item.hourly_price, item.current_pickup_point_id, item.is_available_now)
+
+
+def remove_item(item_id: int) -> None:
+    #убирает вещь из индекса (в шардированном режиме - вещь ушла в постомат другого шарда)
+    old = _items.pop(item_id, None)
+    if old is None:
+        return
+    _all.remove(item_id, old[0])
+    if old[4]:
+        _remove_available(item_id, old[0], old[3])
+
+
+def index_new_items(items: List[Item]) -> None:
+    #добавляет в индекс пачку новых вещей; уже проиндексированные не трогает -
+    #их состояние могло обновиться, пока пачка ждала своей очереди
+    for item in items:
+        if item.id not in _items:
+            index_item(item)
+
+
+def rebuild(items: List[Item]) -> None:
+    global _all, _available
+    _all = _Index()
+    _available = _Index()
+    _available_by_point.clear()
+    _items.clear()
+    for item in items:
+        index_item(item)
+
+
+def _score(query: FrozenSet[str], tokens: FrozenSet[str]) -> float:
+    # доля общих слов (Жаккар): 1.0 - описание совпадает полностью
+    return len(query & tokens) / len(query | tokens)
+
+
+def _candidates(index: _Index, query: FrozenSet[str], accept, enough: int) -> List[int]:
+    #вещи индекса, в описании которых есть все слова запроса и которые проходят фильтр accept;
+    #просматривается не больше SEARCH_SCAN_LIMIT полных совпадений и столько же частичных
+    if not query:
+        return []
+    exact = index.exact.get(query, set())
+    result = [item_id for item_id in islice(exact, SEARCH_SCAN_LIMIT) if accept(item_id)]
+    # полные совпадения ранжируются выше любых частичных
+    if len(result) >= enough or len(exact) >= SEARCH_SCAN_LIMIT:
+        return result
+    # берем первые вещи самого короткого множества и пересекаем с остальными
+    postings = sorted((index.postings.get(token, set()) for token in query), key=len)
+    matched = set(islice(postings[0], SEARCH_SCAN_LIMIT)).intersection(*postings[1:]) - exact
+    return result + [item_id for item_id in matched if accept(item_id)]
+
+
+def _top(query: FrozenSet[str], candidates: List[int], limit: int) -> List[Tuple[float, int]]:
+    #лучшие limit кандидатов: (похожесть, id) по убыванию похожести, затем по цене и id
+    scores: Dict[FrozenSet[str], float] = {}
+
+    def key(item_id: int):
+        item_tokens, _, price, _, _ = _items[item_id]
+        score = scores.get(item_tokens)
+        if score is None:
+            score = scores[item_tokens] = _score(query, item_tokens)
+        return -score, price, item_id
+
+    return [(-key(item_id)[0], item_id) for item_id in heapq.nsmallest(limit, candidates, key=key)]
+
+
+def search(query: str, available_only: bool = True, pickup_point_id: Optional[int] = None, limit: int = 20) -> List[Dict]:
+    #поиск вещей по словам описания
+    tokens = tokenize(query)
+    if not available_only:
+        index = _all
+        accept = lambda item_id: pickup_point_id is None or _items[item_id][3] == pickup_point_id
+    else:
+        index = _available if pickup_point_id is None else _available_by_point.get(pickup_point_id, _Index())
+        accept = lambda item_id: True
+
+    results = []
+    for score, item_id in _top(tokens, _candidates(index, tokens, accept, limit), limit):
+        _, desc, price, ppoint, available = _items[item_id]
+        results.append({
+            "item_id": item_id,
+            "desc": desc,
+            "hourly_price": price,
+            "pickup_point_id": ppoint,
+            "is_available_now": available,
+            "score": round(score, 4)
+        })
+    return results
+
+
+def similar(desc: str, exclude_id: Optional[int] = None, limit: int = ALTERNATIVES_LIMIT) -> List[Tuple[float, int, int, int]]:
+    #доступные сейчас вещи с похожим описанием: (похожесть, цена, id, постомат), лучшие первыми
+    tokens = tokenize(desc)
+    candidates = _candidates(_available, tokens, lambda c: c != exclude_id, limit)
+    return [(score, _items[c][2], c, _items[c][3]) for score, c in _top(tokens, candidates, limit)]
+
+
+def group_by_pickup_point(found: List[Tuple[float, int, int, int]], preferred_pickup_point_id: Optional[int] = None) -> List[Dict]:
+    #группирует результат similar по постоматам
+    groups: Dict[int, Dict] = {}
+    for score, price, candidate_id, ppoint in found:
+        group = groups.get(ppoint)
+        if group is None:
+            group = groups[ppoint] = {"pickup_point_id": ppoint, "item_ids": [], "best_score": round(score, 4)}
+        group["item_ids"].append(candidate_id)
+    # сначала постомат из заказа, дальше по лучшему совпадению и числу вещей
+    return sorted(
+        groups.values(),
+        key=lambda g: (g["pickup_point_id"] != preferred_pickup_point_id, -g["best_score"], -len(g["item_ids"]))
+    )
+
+
+def alternatives(item_id: int, preferred_pickup_point_id: Optional[int] = None, limit: int = ALTERNATIVES_LIMIT,
+                 include_self: bool = False) -> List[Dict]:
+    #доступные сейчас вещи с тем же описанием, сгруппированные по постоматам;
+    #include_self - сама вещь тоже подходит (она свободна, но в другом постомате)
+    indexed = _items.get(item_id)
+    if indexed is None:
+        return []
+    found = similar(indexed[1], None if include_self else item_id, limit)
+    return group_by_pickup_point(found, preferred_pickup_point_id)
+
+
+def stats() -> Dict:
+    return {
+        "items": len(_items),
+        "available_items": sum(len(ids) for ids in _available.exact.values()),
+        "tokens": len(_all.postings),
+        "distinct_descs": len(_all.exact)
+    }
+
+
+def bench(count: int, available_share: float, seed: int, repeat: int = 200) -> None:
+    #замер поиска на count вещах, из которых свободна доля available_share
+    rng = random.Random(seed)
+    words = ["Дрель", "Шуруповерт", "Пила", "Перфоратор", "Болгарка", "Лобзик", "Миксер", "Рубанок"]
+    items = [
+        Item.model_construct(id=100000 + i, desc=f"{words[i % len(words)]} ударная модель {i % 3000}",
+                             hourly_price=100 + i % 50, is_available_now=rng.random() < available_share,
+                             current_pickup_point_id=rng.randrange(1, 200), reserved_until=None)
+        for i in range(count)
+    ]
+    started = time.perf_counter()
+    rebuild(items)
+    print(f"индекс построен за {time.perf_counter() - started:.1f} с: {stats()}")
+
+    sample = [item.id for item in items[:repeat]]
+    cases = [
+        ("alternatives", lambda n: alternatives(sample[n], 5)),
+        ("search 'дрель'", lambda n: search("дрель")),
+        ("search 'дрель' в постомате", lambda n: search("дрель", pickup_point_id=7)),
+        ("search 'дрель' с занятыми", lambda n: search("дрель", available_only=False)),
+        ("search без совпадений", lambda n: search("дрель пила"))
+    ]
+    for name, run in cases:
+        started = time.perf_counter()
+        for n in range(repeat):
+            run(n)
+        print(f"{name:>28}: {(time.perf_counter() - started) / repeat * 1000:.3f} мс")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Поиск по описаниям вещей")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench_parser = sub.add_parser("bench", help="замер поиска и подбора альтернатив")
+    bench_parser.add_argument("--items", type=int, default=1000000)
+    bench_parser.add_argument("--available", type=float, default=0.02, help="доля свободных вещей")
+    bench_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    bench(args.items, args.available, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,15 @@ from datetime import datetime, timedelta
 from models import OrderStatus, CancelReason, Order, Client, Item, Ppoint, OrderCreateRequest, OrderResponse, RentalOrderMessage, ItemCreateRequest, ClientCreateRequest
 from typing import Optional, Dict, List
 import json
+import os
+import itertools
+import archive
+import analytics
+import events
+import profiling
+import search
+import sharding
+import codec
 
 # Заглушка бд заказов
 orders_db: List[Order] = []
@@ -127,6 +136,7 @@ def generate_six_digit_id(salt: str) -> int:
     return 100000 + (full_number % 900000)
     
 
+@profiling.timed
 def find_in_db_by_attribute(table: str, value: int | str | datetime, field: str = 'id'):
   #используется для поиска в БД по атрибуту
   if table == 'orders_db':
@@ -206,6 +216,7 @@ def find_in_db_by_attribute(table: str, value: int | str | datetime, field: str
     raise ItemNotFoundInTable(f"В таблице {table} нет объекта с {field} == {value}")
 
 
+@profiling.timed
 async def check_item_availability(item_id: int, pickup_point_id: int) -> bool:
 #def check_item_availability(item_id: int, pickup_point_id: int) -> bool:
     #Проверяет возможность выдачи вещи.
@@ -245,6 +256,7 @@ async def check_item_availability(item_id: int, pickup_point_id: int) -> bool:
     return(item_availible)
 
 
+@profiling.timed
 async def reserve_item(item_id: int, order_id: int, rental_hours: int) -> None:
 #def reserve_item(item_id: int, order_id: int, rental_hours: int) -> None:
     #Бронирует вещь в БД
@@ -261,10 +273,13 @@ async def reserve_item(item_id: int, order_id: int, rental_hours: int) -> None:
     # Изменяем items_db
     items_db[item_num].is_available_now = False
     items_db[item_num].reserved_until = datetime.now() + timedelta(hours=rental_hours)
+    search.index_item(items_db[item_num])
+    events.publish("item_reserved", order_id=order_id, item_id=item_id, reserved_until=items_db[item_num].reserved_until.isoformat())
 
     print(f"[Бронирование] Вещь {item_id} забронирована для заказа {order_id}")
 
-async def send_sms_cancellation(client_id: int, reason: CancelReason, order_id: int = None):
+@profiling.timed
+async def send_sms_cancellation(client_id: int, reason: CancelReason, order_id: int = None, alternatives: List[dict] = None):
 #def send_sms_cancellation(client_id: int, reason: CancelReason, order_id: int = None):
     #Заглушка для запроса в сервис отправки SMS.
 
@@ -277,8 +292,7 @@ async def send_sms_cancellation(client_id: int, reason: CancelReason, order_id:
     client_num = None
 
     try:
-      client_num = find_in_db_by_attribute('clients_db', client_id)
-      phone_number = clients_db[client_num].phone
+      phone_number = await client_phone(client_id)
 
       # Формируем сообщение в зависимости от причины
       if order_id is None:
@@ -293,6 +307,11 @@ async def send_sms_cancellation(client_id: int, reason: CancelReason, order_id:
       else:
           message = f"Заказ {order_id} отменен."
 
+      if alternatives:
+          # предлагаем такую же вещь в других постоматах
+          offers = "; ".join(f"постомат {a['pickup_point_id']}: {', '.join(str(i) for i in a['item_ids'])}" for a in alternatives[:3])
+          message += f" Такая же вещь доступна: {offers}"
+
       print(f"   To: {phone_number}")
       print(f"   Message: {message}")
 
@@ -308,12 +327,15 @@ async def send_sms_cancellation(client_id: int, reason: CancelReason, order_id:
       print(f"[SMS SERVICE] Клиент {client_id} не найден, SMS не отправлено\n")
       raise ItemNotFoundInTable(f"Клиент с ID {client_id} не найден")
 
+@profiling.timed
 async def create_order_in_db(order_data: OrderCreateRequest) -> OrderResponse:
 #def create_order_in_db(order_data: OrderCreateRequest) -> OrderResponse:
     #создание заказа
     print(f"[Создание заказа] Сохраняем заказ в БД: {order_data}")
     try:
       order_id = generate_six_digit_id('orders_db')
+      if order_id_shard is not None:
+        order_id = _order_id_in_shard(order_id)
       now = datetime.now()
       
       # Создаем заказ со статусом NEW
@@ -331,15 +353,29 @@ async def create_order_in_db(order_data: OrderCreateRequest) -> OrderResponse:
       )
       
       orders_db.append(new_order)
+      analytics.record_order_change(None, new_order, item_hourly_price(new_order.item_id))
+      events.publish("order_created", order=new_order.model_dump(mode='json'))
       print(f"[Создание заказа] Заказ {order_id} создан")
     except:
       raise DatabaseError(f"Заказ не создан")
     return order_id
 
+@profiling.timed
+def item_hourly_price(item_id: int) -> int:
+    #цена часа аренды вещи, 0 если вещи нет в базе
+    try:
+      return items_db[find_in_db_by_attribute('items_db', item_id)].hourly_price
+    except ItemNotFoundInTable:
+      return moved_item_prices.get(item_id, 0)
+
+@profiling.timed
 async def update_order_status(order_id: int, new_status: OrderStatus) -> Order:
 #def update_order_status(order_id: int, new_status: OrderStatus) -> Order:
     #Функция обновляет статус у заказа
     print(f"[Обновление статуса] Заказ {order_id} -> {new_status}")
+
+    if sharding.enabled():
+      return Order.model_validate(await _order_call("update_order_status", order_id, status=new_status.value))
     
     # Ищем заказ
     order_num = None
@@ -349,14 +385,17 @@ async def update_order_status(order_id: int, new_status: OrderStatus) -> Order:
       raise ItemNotFoundError(f"Заказ с ID {order_id} не найден")
     
     
-    if order_num:
-      orders_db[order_num].status = new_status
-      orders_db[order_num].updated_at = datetime.now()
+    old_order = orders_db[order_num].model_copy()
+    orders_db[order_num].status = new_status
+    orders_db[order_num].updated_at = datetime.now()
+    analytics.record_order_change(old_order, orders_db[order_num], item_hourly_price(old_order.item_id))
+    events.publish("order_status_changed", old_status=old_order.status.value, order=orders_db[order_num].model_dump(mode='json'))
     
     print(f"[Обновление статуса] Статус заказа {order_id} обновлен на {new_status}")
     return orders_db[order_num]
 
-async def cancel_order(client_id: int, order_id: int, cancel_reason: CancelReason, error_details: str = None) -> None:
+@profiling.timed
+async def cancel_order(client_id: int, order_id: int, cancel_reason: CancelReason, error_details: str = None, alternatives: List[dict] = None) -> None:
 #def cancel_order(client_id: int, order_id: int, cancel_reason: CancelReason, error_details: str = None) -> None:
     #Функция отмены заказа
     if error_details is None:
@@ -364,21 +403,59 @@ async def cancel_order(client_id: int, order_id: int, cancel_reason: CancelReaso
     else:
       print(f"Отмена заказа по причине: {cancel_reason}. Детали: {error_details}")
     
-    #обновляем статус заказа
+    #обновляем статус заказа (в шардированном режиме - в шарде заказа)
+    if sharding.enabled():
+      await _order_call("cancel_order", order_id, cancel_reason=cancel_reason.value, error_details=error_details, alternatives=alternatives or [])
+    else:
+      mark_order_cancelled(order_id, cancel_reason, error_details, alternatives)
+
+    await send_sms_cancellation(client_id, cancel_reason, order_id, alternatives)
+    #send_sms_cancellation(client_id, cancel_reason, order_id)
+
+def mark_order_cancelled(order_id: int, cancel_reason: CancelReason, error_details: str = None, alternatives: List[dict] = None) -> None:
+    #переводит заказ в CANCELLED (без SMS)
     order_num = None
     try:
       order_num = find_in_db_by_attribute('orders_db', order_id)
     except ItemNotFoundInTable:
       raise ItemNotFoundError(f"Заказ с ID {order_id} не найден")
 
+    old_order = orders_db[order_num].model_copy()
     orders_db[order_num].status = OrderStatus.CANCELLED
     orders_db[order_num].cancel_reason = cancel_reason
     orders_db[order_num].cancel_details = error_details
-
-    await send_sms_cancellation(client_id, order_id, cancel_reason)
-    #send_sms_cancellation(client_id, cancel_reason, order_id)
-
-
+    orders_db[order_num].updated_at = datetime.now()
+    analytics.record_order_change(old_order, orders_db[order_num], item_hourly_price(old_order.item_id))
+    events.publish("order_cancelled", old_status=old_order.status.value, order=orders_db[order_num].model_dump(mode='json'), alternatives=alternatives or [])
+
+@profiling.timed
+async def place_order(order_data: OrderCreateRequest) -> Order:
+    #создает заказ, проверяет и бронирует вещь, переводит заказ в AWAITING_PAYMENT;
+    #если с вещью что-то не так, у ошибки есть order_id созданного заказа (его нужно отменить).
+    #в шардированном режиме все это одной командой делает шард постомата
+    if sharding.enabled():
+      try:
+        return Order.model_validate(await sharding.router.place_order(order_data.model_dump(mode='json')))
+      except sharding.ShardError as e:
+        raise _shard_error(e)
+      except ConnectionError as e:
+        raise DatabaseError(str(e))
+
+    order_id = await create_order_in_db(order_data)
+    print(f"Заказ {order_id} создан")
+    try:
+      await check_item_availability(order_data.item_id, order_data.pickup_point_id)
+      print(f"Проверка доступности пройдена для заказа {order_id}")
+      await reserve_item(order_data.item_id, order_id, order_data.rental_duration_hours)
+    except (ItemNotFoundError, ItemNotAvailableError, ItemNotInLocationError) as e:
+      e.order_id = order_id
+      raise
+    updated_order = await update_order_status(order_id, OrderStatus.AWAITING_PAYMENT)
+    print(f"Статус заказа {order_id} обновлен на AWAITING_PAYMENT")
+    return updated_order
+
+
+@profiling.timed
 async def send_to_kafka(message: RentalOrderMessage):
     # Заглушка для отправки сообщения в Kafka.
     # В реальности здесь была бы отправка сообщения в Kafka topic
@@ -390,6 +467,10 @@ async def send_to_kafka(message: RentalOrderMessage):
     print(f"   Duration: {message.rental_duration_hours} часов")
     print(f"   Timestamp: {message.timestamp}")
 
+    # Сообщение кодируется компактным бинарным форматом, что в него не помещается - в JSON
+    payload, content_type = codec.encode_for_kafka(message)
+    print(f"   Payload: {len(payload)} байт, content-type {content_type}")
+
     # Имитация отправки в Kafka
     await asyncio.sleep(0.5)
     print(f"✅ [KAFKA] Сообщение для заказа {message.order_id} успешно отправлено\n")
@@ -397,15 +478,346 @@ async def send_to_kafka(message: RentalOrderMessage):
 
 #### для new_items
 
-async def add_item(item_data: Item):
-    #добавляет новый item в БД
+def _new_item_id() -> int:
+    return generate_six_digit_id('items_db')
+
+async def item_ids() -> set:
+    #id всех вещей; в шардированном режиме собираются со всех шардов
+    if sharding.enabled():
+      return await sharding.router.item_ids()
+    return set(item.id for item in items_db)
+
+async def item_id_taken(item_id: int) -> bool:
+    if sharding.enabled():
+      return await sharding.router.locate(item_id) is not None
+    try:
+      find_in_db_by_attribute('items_db', item_id)
+      return True
+    except ItemNotFoundInTable:
+      return False
+
+@profiling.timed
+async def add_item(item_data: Item) -> Item:
+    #добавляет новый item в БД; в шардированном режиме id может смениться, если его успели занять
+    if sharding.enabled():
+      #индекс вещи ведет ее шард
+      return Item.model_validate(await _sharded_call(sharding.router.add(item_data.model_dump(mode='json'), _new_item_id)))
     items_db.append(item_data)
+    search.index_item(item_data)
+    return item_data
+
+
+# Сколько вещей массового импорта индексируем для поиска за один шаг цикла событий
+SEARCH_INDEX_BATCH = int(os.getenv("SEARCH_INDEX_BATCH", "1000"))
+
+@profiling.timed
+async def add_items(items: List[Item]) -> List[Item]:
+    #добавляет пачку item в БД (массовый импорт), возвращает записанные вещи
+    if sharding.enabled():
+      dumped = await asyncio.to_thread(lambda: [i.model_dump(mode='json') for i in items])
+      stored = await _sharded_call(sharding.router.add_many(dumped, _new_item_id))
+      return await asyncio.to_thread(lambda: [Item.model_validate(i) for i in stored])
+    items_db.extend(items)
+    # индекс обновляем пачками, отдавая управление между ними другим запросам
+    for start in range(0, len(items), SEARCH_INDEX_BATCH):
+      search.index_new_items(items[start:start + SEARCH_INDEX_BATCH])
+      await asyncio.sleep(0)
+    return items
 
 
 class PPointNotFound(Exception):
   #ошибка что ppoint не найден
     pass
 
+@profiling.timed
 async def add_client(client_data: Client):
     #добавляет новый client в БД
     clients_db.append(client_data)
+
+async def client_phone(client_id: int) -> str:
+    #телефон клиента; в шардированном режиме клиенты в шарде 0
+    if sharding.enabled():
+      client = await sharding.router.clients[0].call("client", client_id=client_id)
+      if client is None:
+        raise ItemNotFoundInTable(f"В таблице clients_db нет объекта с id == {client_id}")
+      return client['phone']
+    return clients_db[find_in_db_by_attribute('clients_db', client_id)].phone
+
+@profiling.timed
+async def add_clients(clients: List[Client]):
+    #добавляет пачку client в БД (массовый импорт)
+    clients_db.extend(clients)
+
+
+#### архив завершенных заказов
+
+# Заказы в этих статусах больше не меняются и могут уйти в архив
+FINISHED_ORDER_STATUSES = (OrderStatus.CANCELLED, OrderStatus.RETURNED)
+# Через сколько часов после последнего изменения завершенный заказ уходит в архив
+ARCHIVE_MIN_AGE_HOURS = float(os.getenv("ARCHIVE_MIN_AGE_HOURS", "24"))
+
+# Проходы архивации идут по одному
+_archive_lock = asyncio.Lock()
+
+@profiling.timed
+async def archive_finished_orders(min_age_hours: float = None, now: datetime = None) -> int:
+    #переносит завершенные заказы старше min_age_hours из orders_db в архив
+    if sharding.enabled():
+      #каждый шард архивирует свои заказы
+      return sum(await _sharded_call(sharding.router.gather("archive", min_age_hours=min_age_hours)))
+    if min_age_hours is None:
+      min_age_hours = ARCHIVE_MIN_AGE_HOURS
+    if now is None:
+      now = datetime.now()
+    border = now - timedelta(hours=min_age_hours)
+
+    async with _archive_lock:
+      to_archive = [o for o in orders_db if o.status in FINISHED_ORDER_STATUSES and o.updated_at <= border]
+      if not to_archive:
+        return 0
+
+      # запись на диск (zlib, fsync, слияние сегментов) - в отдельном потоке, чтобы не останавливать
+      # event loop; пока она идет, заказы остаются в orders_db и доступны как обычно
+      await asyncio.to_thread(archive.append_orders, to_archive)
+      # убираем из горячей таблицы уже снова в event loop
+      archived_ids = set(id(o) for o in to_archive)
+      orders_db[:] = [o for o in orders_db if id(o) not in archived_ids]
+
+    print(f"[ARCHIVE] В архив перенесено заказов: {len(to_archive)}, в orders_db осталось: {len(orders_db)}")
+    return len(to_archive)
+
+@profiling.timed
+async def get_order(order_id: int) -> Order:
+    #ищет заказ сначала в orders_db, потом в архиве (в шардированном режиме - в шарде заказа)
+    if sharding.enabled():
+      return Order.model_validate(await _order_call("get_order", order_id))
+    try:
+      return orders_db[find_in_db_by_attribute('orders_db', order_id)]
+    except ItemNotFoundInTable:
+      pass
+
+    order = archive.get_order(order_id)
+    if order is None:
+      raise ItemNotFoundError(f"Заказ с ID {order_id} не найден")
+    return order
+
+async def storage_counts() -> dict:
+    #заказов в orders_db и сегментов архива (в шардированном режиме - сумма по шардам)
+    if sharding.enabled():
+      parts = await _sharded_call(sharding.router.gather("storage_counts"))
+      return {key: sum(part[key] for part in parts) for key in ("orders_count", "segments_count")}
+    return {"orders_count": len(orders_db), "segments_count": archive.segments_count()}
+
+async def iter_orders(include_archived: bool = True):
+    #все заказы пачками: горячие, потом архив; в шардированном режиме - шард за шардом
+    if sharding.enabled():
+      async for part in sharding.router.orders(include_archived):
+        yield part
+      return
+    yield [o.model_dump(mode='json') for o in orders_db]
+    if include_archived:
+      archived = archive.iter_orders()
+      try:
+        while True:
+          part = await asyncio.to_thread(lambda: [o.model_dump(mode='json') for o in itertools.islice(archived, 1000)])
+          if not part:
+            return
+          yield part
+      finally:
+        archived.close()
+
+
+#### аналитика
+
+def rebuild_analytics(replace: bool = False) -> dict:
+    #пересчитывает агрегаты с нуля по orders_db и архиву
+    def all_orders():
+      yield from orders_db
+      yield from archive.iter_orders()
+
+    rebuilt = analytics.compute_from_scratch(all_orders(), item_hourly_price)
+    if replace:
+      analytics.reset(all_orders(), item_hourly_price)
+    return rebuilt
+
+async def load_analytics() -> None:
+    #при старте: архив на диске переживает рестарт, а счетчики в памяти - нет,
+    #поэтому заполняем их по orders_db и архиву (чтение архива - в отдельном потоке).
+    #в шардированном режиме счетчики ведут шарды, каждый заполняет свои при старте
+    if sharding.enabled():
+      return
+    await asyncio.to_thread(rebuild_analytics, True)
+
+async def get_analytics(rebuild: bool = False) -> dict:
+    #агрегаты по вещам и постоматам; rebuild - пересчет с нуля и сверка с инкрементальными
+    if sharding.enabled():
+      parts = await _sharded_call(sharding.router.gather("analytics", rebuild=rebuild))
+      merged = analytics.merge_snapshots(parts)
+      if rebuild:
+        merged["consistent"] = all(part["consistent"] for part in parts)
+      return merged
+    if not rebuild:
+      return analytics.snapshot()
+    rebuilt = rebuild_analytics()
+    return {**rebuilt, "consistent": analytics.is_consistent(rebuilt)}
+
+async def get_item_analytics(item_id: int) -> dict:
+    #заказы вещи могут быть в нескольких шардах (вещь переносили)
+    if sharding.enabled():
+      return analytics.merge_stats(await _sharded_call(sharding.router.gather("item_stats", item_id=item_id)))
+    return analytics.get_item_stats(item_id)
+
+async def get_pickup_point_analytics(pickup_point_id: int) -> dict:
+    if sharding.enabled():
+      client = sharding.router.client_for(pickup_point_id)
+      return await _sharded_call(client.call("pickup_point_stats", pickup_point_id=pickup_point_id))
+    return analytics.get_pickup_point_stats(pickup_point_id)
+
+
+#### снимок таблиц (запись и воспроизведение трафика)
+
+def dump_tables() -> dict:
+    #снимок таблиц в виде JSON-совместимых словарей
+    return {
+      'orders_db': [o.model_dump(mode='json') for o in orders_db],
+      'items_db': [i.model_dump(mode='json') for i in items_db],
+      'clients_db': [c.model_dump(mode='json') for c in clients_db],
+      'pickup_points_db': [p.model_dump(mode='json') for p in pickup_points_db]
+    }
+
+async def snapshot_tables() -> dict:
+    #снимок таблиц для записи трафика; в шардированном режиме вещи, заказы и клиенты - из шардов
+    if not sharding.enabled():
+      return dump_tables()
+    parts = await _sharded_call(sharding.router.gather("dump"))
+    return {
+      'orders_db': [o for part in parts for o in part['orders_db']],
+      'items_db': [i for part in parts for i in part['items_db']],
+      'clients_db': parts[0]['clients_db'],
+      'pickup_points_db': [p.model_dump(mode='json') for p in pickup_points_db]
+    }
+
+def load_tables(tables: dict) -> None:
+    #заменяет содержимое таблиц снимком из dump_tables
+    orders_db[:] = [Order.model_validate(o) for o in tables['orders_db']]
+    items_db[:] = [Item.model_validate(i) for i in tables['items_db']]
+    clients_db[:] = [Client.model_validate(c) for c in tables['clients_db']]
+    pickup_points_db[:] = [Ppoint.model_validate(p) for p in tables['pickup_points_db']]
+    search.rebuild(items_db)
+    rebuild_analytics(replace=True)
+
+
+#### поиск вещей
+
+async def find_alternatives(item_id: int, preferred_pickup_point_id: int = None, include_self: bool = False) -> List[dict]:
+    #доступные сейчас вещи с тем же описанием, сгруппированные по постоматам
+    if not sharding.enabled():
+      return search.alternatives(item_id, preferred_pickup_point_id, include_self=include_self)
+
+    # каждый шард ищет среди своих вещей, лучшие из всех сводим здесь
+    try:
+      item = await sharding.router.locate(item_id)
+      if item is None:
+        return []
+      parts = await sharding.router.gather("similar", desc=item['desc'], exclude_id=None if include_self else item_id, limit=search.ALTERNATIVES_LIMIT)
+    except (sharding.ShardError, ConnectionError) as e:
+      print(f"[Поиск] Не удалось получить альтернативы из шардов: {e}")
+      return []
+    found = sorted((tuple(f) for part in parts for f in part), key=lambda f: (-f[0], f[1], f[2]))
+    return search.group_by_pickup_point(found[:search.ALTERNATIVES_LIMIT], preferred_pickup_point_id)
+
+async def search_items(query: str, available_only: bool = True, pickup_point_id: int = None, limit: int = 20) -> List[dict]:
+    #поиск вещей по описанию; в шардированном режиме - по шардам, с постоматом - только в его шарде
+    if not sharding.enabled():
+      return search.search(query, available_only, pickup_point_id, limit)
+    params = dict(query=query, available_only=available_only, pickup_point_id=pickup_point_id, limit=limit)
+    if pickup_point_id is not None:
+      return await _sharded_call(sharding.router.client_for(pickup_point_id).call("search", **params))
+    parts = await _sharded_call(sharding.router.gather("search", **params))
+    found = [r for part in parts for r in part]
+    return sorted(found, key=lambda r: (-r['score'], r['hourly_price'], r['item_id']))[:limit]
+
+# индекс строится при загрузке модуля (и заново при /api/debug/reset)
+search.rebuild(items_db)
+
+
+#### шардированный режим (см. sharding.py)
+
+# В процессе шарда: (номер шарда, число шардов) - id заказов шарда дают остаток номер шарда
+order_id_shard = None
+
+# В процессе шарда: цены вещей, ушедших в постомат другого шарда -
+# их заказы остались здесь, и аналитике нужна цена
+moved_item_prices: Dict[int, int] = {}
+
+_shard_errors = {
+    'not_found': ItemNotFoundError,
+    'not_available': ItemNotAvailableError,
+    'not_in_location': ItemNotInLocationError
+}
+
+def _order_id_in_shard(order_id: int) -> int:
+    #ближайший шестизначный id с остатком номер шарда
+    shard, shards = order_id_shard
+    order_id += (shard - order_id) % shards
+    if order_id > 999999:
+      order_id -= shards
+    return order_id
+
+def _shard_error(e: sharding.ShardError) -> Exception:
+    #ошибка services по ошибке шарда
+    error = _shard_errors.get(e.kind, DatabaseError)(str(e))
+    if e.details.get('order_id') is not None:
+      error.order_id = e.details['order_id']
+    return error
+
+async def _sharded_call(call):
+    #ждет ответ шарда и переводит ошибки шарда в ошибки services
+    try:
+      return await call
+    except sharding.ShardError as e:
+      raise _shard_error(e)
+    except ConnectionError as e:
+      raise DatabaseError(str(e))
+
+async def _order_call(op: str, order_id: int, **params):
+    #операция над заказом в шарде, которому он принадлежит
+    return await _sharded_call(sharding.router.order_call(op, order_id, **params))
+
+async def register_clients_in_shard(rows: List[tuple], dry_run: bool = False):
+    #регистрация клиентов в шарде 0 (см. bulk_import.register_clients)
+    result = await _sharded_call(sharding.router.clients[0].call("register_clients", rows=rows, dry_run=dry_run))
+    return [Client.model_validate(c) for c in result['clients']], result['errors']
+
+async def reset_shards() -> None:
+    #сброс всех шардов к начальному состоянию (для /api/debug/reset)
+    await _sharded_call(sharding.router.gather("reset"))
+
+async def get_items() -> List[Item]:
+    #все вещи; в шардированном режиме собираются со всех шардов
+    if sharding.enabled():
+      return [Item.model_validate(i) for i in await _sharded_call(sharding.router.all_items())]
+    return items_db
+
+@profiling.timed
+async def move_item(item_id: int, new_pickup_point_id: int) -> Item:
+    #переносит свободную вещь в другой постомат (в шардированном режиме индекс ведут шарды)
+    try:
+      find_in_db_by_attribute('pickup_points_db', new_pickup_point_id)
+    except ItemNotFoundInTable:
+      raise PPointNotFound(f"Не существует pickup_point с id {new_pickup_point_id}")
+
+    if sharding.enabled():
+      item = Item.model_validate(await _sharded_call(sharding.router.move(item_id, new_pickup_point_id)))
+    else:
+      try:
+        item = items_db[find_in_db_by_attribute('items_db', item_id)]
+      except ItemNotFoundInTable:
+        raise ItemNotFoundError(f"Вещь с ID {item_id} не найдена")
+      if not item.is_available_now:
+        raise ItemNotAvailableError(f"Вещь {item_id} забронирована, перенос невозможен")
+      item.current_pickup_point_id = new_pickup_point_id
+      search.index_item(item)
+
+    print(f"[Перенос] Вещь {item_id} перенесена в постомат {new_pickup_point_id}")
+    return item
@@ -0,0 +1,864 @@
+"""
+Шардированный режим: вещи, заказы и все, что от них зависит, разбиты по
+постоматам между процессами-шардами.
+
+Шард i владеет постоматами, у которых id % SHARDS == i: их вещами, заказами
+(id заказа шарда i тоже дает остаток i, поэтому шард заказа находится по id),
+аналитикой по этим заказам, лентой событий, поисковым индексом по своим вещам
+и своим архивом (ARCHIVE_DIR/shard_<i>). Шард 0 кроме того владеет клиентами:
+phone и email уникальны во всей базе. Внутри шарда работает обычный services
+над своей частью данных, команды выполняются в одном потоке, поэтому создание
+заказа, проверка и бронь вещи и смена статуса идут одной командой и между ними
+никто не вклинится.
+
+Процессы приложения своих данных не держат, поэтому их может быть несколько
+(несколько uvicorn за балансировщиком или uvicorn --workers N): они разбирают HTTP, делают контроль допуска, отправку
+в Kafka и SMS, а каждую операцию отдают шарду-владельцу по unix-сокету
+(SHARD_SOCKET_DIR/shard_<i>.sock): сообщение - 4 байта длины + JSON.
+
+Межшардовые операции выполняются явно:
+- вещь не нашлась у шарда постомата из заказа - опрашиваем остальные шарды,
+  чтобы отличить "вещь в другом постомате" от "вещи нет";
+- альтернативы и поиск: каждый шард отдает лучшие совпадения среди своих
+  вещей, приложение сводит их в одну выдачу;
+- перенос вещи в постомат другого шарда: take у старого шарда, put у нового
+  (при ошибке put вещь возвращается обратно);
+- новые вещи: id сверяется со всеми шардами, а шард отвергает id, который
+  у него уже есть (duplicate), - тогда роутер выдает вещи новый id;
+- глобальное чтение (вещи, заказы с архивом, аналитика, снимок таблиц)
+  собирается со всех шардов;
+- лента событий: процесс приложения с первым SSE-клиентом подписывается на
+  события всех шардов и раздает их своим SSE-клиентам со своими id; если
+  подписка оборвалась, процесс меняет epoch ленты, и переподключившиеся
+  клиенты получают resync.
+
+Запуск:
+    python sharding.py serve --shards 4
+    SHARDS=4 uvicorn main:app --port 8000   (и так же на 8001, 8002, ... за балансировщиком)
+Сквозной замер через POST /api/new_orders (0 - без шардов, один процесс):
+    python sharding.py bench --shards 0,1,2,4
+Процессы приложения в замере - отдельные uvicorn на соседних портах: у воркеров
+uvicorn --workers ответы на keep-alive соединениях задерживаются на ~40 мс.
+"""
+import os
+import sys
+import json
+import time
+import random
+import struct
+import asyncio
+import argparse
+import importlib
+import subprocess
+import multiprocessing
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+
+# Число шардов (0 - шардирование выключено, все данные в services этого процесса)
+SHARDS = int(os.getenv("SHARDS", "0"))
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp/rent_service_shards")
+# Сколько событий шарда ждут отправки одному процессу приложения; при переполнении подписка рвется
+SHARD_EVENTS_BUFFER = int(os.getenv("SHARD_EVENTS_BUFFER", "10000"))
+
+_HEADER = struct.Struct("!I")
+
+# Команды, на которые шард отвечает несколькими сообщениями
+_STREAM_OPS = {"orders", "subscribe"}
+# Команды, которые ждут диск или потоки: выполняются отдельной задачей, не задерживая соединение
+_BACKGROUND_OPS = _STREAM_OPS | {"archive", "get_order", "register_clients", "reset"}
+
+
+class ShardError(Exception):
+  #ошибка, которую вернул шард; kind - not_found, not_available, not_in_location,
+  #duplicate (id уже занят), wrong_shard, bad_request, internal;
+  #details - данные к ошибке (например, order_id созданного заказа)
+    def __init__(self, kind: str, message: str, details: Optional[dict] = None):
+        super().__init__(message)
+        self.kind = kind
+        self.details = details or {}
+
+
+def enabled() -> bool:
+    return SHARDS > 0
+
+
+def shard_for(pickup_point_id: int, shards: int = None) -> int:
+    return pickup_point_id % (shards or SHARDS)
+
+
+def socket_path(shard: int) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f"shard_{shard}.sock")
+
+
+async def _read_message(reader: asyncio.StreamReader) -> dict:
+    header = await reader.readexactly(_HEADER.size)
+    return json.loads(await reader.readexactly(_HEADER.unpack(header)[0]))
+
+
+def _pack(message: dict) -> bytes:
+    data = json.dumps(message, ensure_ascii=False, default=str).encode("utf-8")
+    return _HEADER.pack(len(data)) + data
+
+
+def _error_kind(error: Exception) -> str:
+    #вид ошибки services для ответа шарда
+    import services
+    kinds = {
+        services.ItemNotFoundError: "not_found",
+        services.ItemNotAvailableError: "not_available",
+        services.ItemNotInLocationError: "not_in_location"
+    }
+    return kinds.get(type(error), "internal")
+
+
+#### процесс шарда
+
+class ShardServer:
+    #владелец своих постоматов: services этого процесса держит только их данные
+    def __init__(self, shard: int, shards: int, seed: bool = True):
+        self.shard = shard
+        self.shards = shards
+        self.ops = 0
+        self._take_slice(seed)
+
+    def _take_slice(self, seed: bool = True) -> None:
+        #оставляет в services только данные своих постоматов
+        import services
+        import search
+        services.order_id_shard = (self.shard, self.shards)
+        if not seed:
+            services.items_db.clear()
+        services.items_db[:] = [i for i in services.items_db if shard_for(i.current_pickup_point_id, self.shards) == self.shard]
+        services.orders_db[:] = [o for o in services.orders_db if shard_for(o.pickup_point_id, self.shards) == self.shard]
+        if self.shard != 0:
+            services.clients_db.clear()
+        # вещи по id - те же объекты, что в items_db
+        self.items = {item.id: item for item in services.items_db}
+        search.rebuild(services.items_db)
+        # архив шарда переживает рестарт, счетчики - нет
+        services.rebuild_analytics(replace=True)
+
+    def _check_put(self, item) -> None:
+        if shard_for(item.current_pickup_point_id, self.shards) != self.shard:
+            raise ShardError("wrong_shard", f"Постомат {item.current_pickup_point_id} не принадлежит шарду {self.shard}")
+
+    def _store(self, item) -> None:
+        import services
+        services.items_db.append(item)
+        self.items[item.id] = item
+
+    # вещи
+
+    def _op_locate(self, item_id: int):
+        item = self.items.get(item_id)
+        return item.model_dump(mode="json") if item is not None else None
+
+    def _op_get_many(self, item_ids: List[int]):
+        return [self._op_locate(item_id) for item_id in item_ids]
+
+    def _op_ids(self):
+        return list(self.items)
+
+    def _op_items(self):
+        return [item.model_dump(mode="json") for item in self.items.values()]
+
+    def _op_put(self, item: dict):
+        import search
+        from models import Item
+        item = Item.model_validate(item)
+        self._check_put(item)
+        if item.id in self.items:
+            raise ShardError("duplicate", f"Вещь с ID {item.id} уже есть в шарде {self.shard}")
+        self._store(item)
+        search.index_item(item)
+        return item.model_dump(mode="json")
+
+    def _op_put_many(self, items: List[dict]):
+        # занятые id не перезаписываем, а возвращаем - роутер выдаст им новые
+        import search
+        from models import Item
+        items = [Item.model_validate(item) for item in items]
+        for item in items:
+            self._check_put(item)
+        added = []
+        duplicates = []
+        for item in items:
+            if item.id in self.items:
+                duplicates.append(item.id)
+            else:
+                self._store(item)
+                added.append(item)
+        search.index_new_items(added)
+        return {"added": len(added), "duplicates": duplicates}
+
+    def _op_take(self, item_id: int):
+        import services
+        import search
+        item = self.items.get(item_id)
+        if item is None:
+            raise ShardError("not_found", f"Вещь с ID {item_id} не найдена в шарде {self.shard}")
+        if not item.is_available_now:
+            raise ShardError("not_available", f"Вещь {item_id} забронирована, перенос невозможен")
+        del self.items[item_id]
+        services.items_db.remove(item)
+        search.remove_item(item_id)
+        # заказы по вещи остаются в этом шарде, аналитике по ним нужна ее цена
+        services.moved_item_prices[item_id] = item.hourly_price
+        return item.model_dump(mode="json")
+
+    # заказы
+
+    async def _op_place_order(self, order: dict):
+        import services
+        from models import OrderCreateRequest
+        try:
+            placed = await services.place_order(OrderCreateRequest.model_validate(order))
+        except (services.ItemNotFoundError, services.ItemNotAvailableError, services.ItemNotInLocationError) as e:
+            raise ShardError(_error_kind(e), str(e), {"order_id": getattr(e, "order_id", None)})
+        return placed.model_dump(mode="json")
+
+    def _op_cancel_order(self, order_id: int, cancel_reason: str, error_details: Optional[str], alternatives: List[dict]):
+        import services
+        from models import CancelReason
+        services.mark_order_cancelled(order_id, CancelReason(cancel_reason), error_details, alternatives)
+
+    async def _op_update_order_status(self, order_id: int, status: str):
+        import services
+        from models import OrderStatus
+        return (await services.update_order_status(order_id, OrderStatus(status))).model_dump(mode="json")
+
+    async def _op_get_order(self, order_id: int):
+        import services
+        return (await services.get_order(order_id)).model_dump(mode="json")
+
+    async def _op_orders(self, include_archived: bool):
+        #заказы шарда пачками: сначала горячие, потом архив
+        import services
+        async for part in services.iter_orders(include_archived):
+            yield part
+
+    async def _op_archive(self, min_age_hours: Optional[float]):
+        import services
+        return await services.archive_finished_orders(min_age_hours)
+
+    def _op_storage_counts(self):
+        import services
+        import archive
+        return {"orders_count": len(services.orders_db), "segments_count": archive.segments_count()}
+
+    # аналитика и поиск
+
+    def _op_analytics(self, rebuild: bool):
+        import services
+        import analytics
+        if not rebuild:
+            return analytics.snapshot()
+        rebuilt = services.rebuild_analytics()
+        return {**rebuilt, "consistent": analytics.is_consistent(rebuilt)}
+
+    def _op_item_stats(self, item_id: int):
+        import analytics
+        return analytics.get_item_stats(item_id)
+
+    def _op_pickup_point_stats(self, pickup_point_id: int):
+        import analytics
+        return analytics.get_pickup_point_stats(pickup_point_id)
+
+    def _op_search(self, query: str, available_only: bool, pickup_point_id: Optional[int], limit: int):
+        import search
+        return search.search(query, available_only, pickup_point_id, limit)
+
+    def _op_similar(self, desc: str, exclude_id: Optional[int], limit: int):
+        import search
+        return search.similar(desc, exclude_id, limit)
+
+    # клиенты (шард 0)
+
+    def _op_client(self, client_id: int):
+        import services
+        try:
+            return services.clients_db[services.find_in_db_by_attribute('clients_db', client_id)].model_dump(mode="json")
+        except services.ItemNotFoundInTable:
+            return None
+
+    async def _op_register_clients(self, rows: List[list], dry_run: bool):
+        import bulk_import
+        clients, errors = await bulk_import.register_clients([tuple(row) for row in rows], dry_run)
+        return {"clients": [client.model_dump(mode="json") for client in clients], "errors": errors}
+
+    # лента событий
+
+    async def _op_subscribe(self):
+        #пересылает события шарда процессу приложения, пока тот успевает их читать
+        import events
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SHARD_EVENTS_BUFFER)
+        overflow = False
+
+        def listener(event_type: str, data: dict) -> None:
+            nonlocal overflow
+            try:
+                queue.put_nowait({"type": event_type, "data": data})
+            except asyncio.QueueFull:
+                overflow = True
+
+        events.broadcaster.listeners.append(listener)
+        try:
+            while not overflow:
+                batch = [await queue.get()]
+                while not queue.empty() and len(batch) < 1000:
+                    batch.append(queue.get_nowait())
+                yield batch
+            print(f"[SHARD {self.shard}] Подписчик ленты не успевает читать, подписка закрыта")
+        finally:
+            events.broadcaster.listeners.remove(listener)
+
+    # служебные
+
+    def _op_dump(self):
+        import services
+        return services.dump_tables()
+
+    def _op_reset(self):
+        #сброс к начальному состоянию (для /api/debug/reset)
+        import services
+        import archive
+        importlib.reload(services)
+        archive.clear()
+        self._take_slice()
+
+    def _op_stats(self):
+        import services
+        return {"shard": self.shard, "items": len(self.items), "orders": len(services.orders_db), "ops": self.ops, "pid": os.getpid()}
+
+    async def _respond(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        self.ops += 1
+        op = request["op"]
+        params = {key: value for key, value in request.items() if key not in ("id", "op")}
+        try:
+            handler = getattr(self, f"_op_{op}", None)
+            if handler is None:
+                raise ShardError("bad_request", f"Неизвестная операция {op}")
+            if op in _STREAM_OPS:
+                async for part in handler(**params):
+                    writer.write(_pack({"id": request["id"], "result": part, "more": True}))
+                    await writer.drain()
+                result = None
+            else:
+                result = handler(**params)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            response = {"id": request["id"], "result": result}
+        except ShardError as e:
+            response = {"id": request["id"], "error": e.kind, "message": str(e), "details": e.details}
+        except Exception as e:
+            kind = _error_kind(e)
+            if kind == "internal":
+                print(f"[SHARD {self.shard}] Ошибка в операции {op}: {e!r}")
+            response = {"id": request["id"], "error": kind, "message": str(e), "details": {}}
+        writer.write(_pack(response))
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        tasks: Set[asyncio.Task] = set()
+        try:
+            while True:
+                request = await _read_message(reader)
+                if request["op"] in _BACKGROUND_OPS:
+                    task = asyncio.create_task(self._respond(request, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    # остальные команды не уступают цикл событий - выполняем по порядку
+                    await self._respond(request, writer)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+
+def run_shard(shard: int, shards: int, seed: bool = True, quiet: bool = False) -> None:
+    #точка входа процесса шарда; quiet - без вывода (для замера)
+    global SHARDS, router
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    # внутри шарда services работает в обычном режиме над своей частью данных
+    # (модуль берем через import: при запуске "python sharding.py" этот файл - __main__)
+    import sharding as module
+    SHARDS = module.SHARDS = 0
+    router = module.router = None
+    import archive
+    archive.ARCHIVE_DIR = os.path.join(archive.ARCHIVE_DIR, f"shard_{shard}")
+
+    server = ShardServer(shard, shards, seed)
+    path = socket_path(shard)
+    os.makedirs(SHARD_SOCKET_DIR, exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+
+    async def main():
+        srv = await asyncio.start_unix_server(server.serve_connection, path=path)
+        print(f"[SHARD {shard}] Слушаем {path}, вещей: {len(server.items)}")
+        async with srv:
+            await srv.serve_forever()
+
+    asyncio.run(main())
+
+
+def start_shards(shards: int, seed: bool = True, quiet: bool = False) -> List[multiprocessing.Process]:
+    processes = []
+    # старые сокеты удаляем заранее, чтобы ожидание ниже не сработало на них
+    for shard in range(shards):
+        if os.path.exists(socket_path(shard)):
+            os.remove(socket_path(shard))
+    for shard in range(shards):
+        process = multiprocessing.Process(target=run_shard, args=(shard, shards, seed, quiet), name=f"shard-{shard}", daemon=True)
+        process.start()
+        processes.append(process)
+    deadline = time.time() + 30
+    while time.time() < deadline and not all(os.path.exists(socket_path(s)) for s in range(shards)):
+        time.sleep(0.05)
+    return processes
+
+
+#### клиентская часть (процесс приложения)
+
+# Сколько раз подряд пробуем выдать вещи новый id, прежде чем сдаться
+MAX_ID_ATTEMPTS = 1000
+
+
+class ShardClient:
+    #одно соединение с шардом, запросы идут конвейером с id
+    def __init__(self, shard: int):
+        self.shard = shard
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        # id запроса -> future ответа или очередь сообщений потоковой команды
+        self.pending: Dict[int, object] = {}
+        self.next_id = 0
+        self._connecting: Optional[asyncio.Lock] = None
+
+    async def _connect(self) -> None:
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self.writer is not None:
+                return
+            self.reader, self.writer = await asyncio.open_unix_connection(socket_path(self.shard))
+            asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                response = await _read_message(self.reader)
+                target = self.pending.get(response["id"])
+                if isinstance(target, asyncio.Queue):
+                    if not response.get("more"):
+                        del self.pending[response["id"]]
+                    target.put_nowait(response)
+                elif target is not None:
+                    del self.pending[response["id"]]
+                    if not target.done():
+                        target.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            error = ConnectionError(f"Шард {self.shard} недоступен: {e}")
+            for target in self.pending.values():
+                if isinstance(target, asyncio.Queue):
+                    target.put_nowait(error)
+                elif not target.done():
+                    target.set_exception(error)
+            self.pending.clear()
+            self.writer = None
+
+    def _send(self, op: str, params: dict, target) -> None:
+        self.next_id += 1
+        self.pending[self.next_id] = target
+        self.writer.write(_pack({"id": self.next_id, "op": op, **params}))
+
+    @staticmethod
+    def _result(response: dict):
+        if "error" in response:
+            raise ShardError(response["error"], response["message"], response.get("details"))
+        return response["result"]
+
+    async def call(self, op: str, **params):
+        if self.writer is None:
+            await self._connect()
+        future = asyncio.get_running_loop().create_future()
+        self._send(op, params, future)
+        return self._result(await future)
+
+    async def stream(self, op: str, **params) -> AsyncIterator:
+        #команда, на которую шард отвечает несколькими сообщениями
+        if self.writer is None:
+            await self._connect()
+        queue: asyncio.Queue = asyncio.Queue()
+        self._send(op, params, queue)
+        while True:
+            response = await queue.get()
+            if isinstance(response, Exception):
+                raise response
+            result = self._result(response)
+            if not response.get("more"):
+                return
+            yield result
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ShardRouter:
+    #направляет операции шарду, который владеет постоматом или заказом
+    def __init__(self, shards: int):
+        self.shards = shards
+        self.clients = [ShardClient(shard) for shard in range(shards)]
+        self._adding: Optional[asyncio.Lock] = None
+
+    def _add_lock(self) -> asyncio.Lock:
+        # проверка id по всем шардам и запись идут под одной блокировкой
+        if self._adding is None:
+            self._adding = asyncio.Lock()
+        return self._adding
+
+    @staticmethod
+    def _free_id(taken: Set[int], next_id: Callable[[], int]) -> int:
+        for _ in range(MAX_ID_ATTEMPTS):
+            new_id = next_id()
+            if new_id not in taken:
+                taken.add(new_id)
+                return new_id
+        raise ShardError("duplicate", "Не удалось подобрать свободный id для вещи")
+
+    def client_for(self, pickup_point_id: int) -> ShardClient:
+        return self.clients[shard_for(pickup_point_id, self.shards)]
+
+    def client_for_order(self, order_id: int) -> ShardClient:
+        # id заказа дает тот же остаток, что и постомат заказа
+        return self.clients[order_id % self.shards]
+
+    async def gather(self, op: str, **params) -> List:
+        #одна команда всем шардам, результаты по порядку шардов
+        return list(await asyncio.gather(*(client.call(op, **params) for client in self.clients)))
+
+    async def locate(self, item_id: int, skip: Optional[int] = None) -> Optional[dict]:
+        #ищет вещь во всех шардах (межшардовая операция)
+        others = [client for client in self.clients if client.shard != skip]
+        for item in await asyncio.gather(*(client.call("locate", item_id=item_id) for client in others)):
+            if item is not None:
+                return item
+        return None
+
+    async def place_order(self, order: dict) -> dict:
+        #создание заказа, проверка и бронь вещи и перевод в AWAITING_PAYMENT - одной командой шарду постомата
+        client = self.client_for(order["pickup_point_id"])
+        try:
+            return await client.call("place_order", order=order)
+        except ShardError as e:
+            if e.kind != "not_found":
+                raise
+            # у шарда постомата вещи нет - возможно, она в постомате другого шарда
+            item = await self.locate(order["item_id"], skip=client.shard)
+            if item is None:
+                raise
+            raise ShardError(
+                "not_in_location",
+                f"Вещь {order['item_id']} находится в постомате {item['current_pickup_point_id']}, а не в {order['pickup_point_id']}",
+                e.details
+            )
+
+    async def order_call(self, op: str, order_id: int, **params):
+        return await self.client_for_order(order_id).call(op, order_id=order_id, **params)
+
+    async def orders(self, include_archived: bool) -> AsyncIterator[List[dict]]:
+        #заказы всех шардов пачками, шард за шардом
+        for client in self.clients:
+            async for part in client.stream("orders", include_archived=include_archived):
+                yield part
+
+    async def item_ids(self) -> Set[int]:
+        #id всех вещей во всех шардах
+        parts = await self.gather("ids")
+        return set(item_id for part in parts for item_id in part)
+
+    async def add(self, item: dict, next_id: Callable[[], int]) -> dict:
+        #добавляет вещь; если ее id уже занят в каком-либо шарде, выдает новый через next_id
+        async with self._add_lock():
+            for _ in range(MAX_ID_ATTEMPTS):
+                if await self.locate(item["id"]) is None:
+                    try:
+                        return await self.client_for(item["current_pickup_point_id"]).call("put", item=item)
+                    except ShardError as e:
+                        if e.kind != "duplicate":
+                            raise
+                item = dict(item, id=next_id())
+        raise ShardError("duplicate", "Не удалось подобрать свободный id для вещи")
+
+    async def add_many(self, items: List[dict], next_id: Callable[[], int]) -> List[dict]:
+        #добавляет пачку вещей, занятые id заменяет новыми; возвращает записанные вещи
+        async with self._add_lock():
+            taken = await self.item_ids()
+            pending = []
+            for item in items:
+                if item["id"] in taken:
+                    item = dict(item, id=self._free_id(taken, next_id))
+                taken.add(item["id"])
+                pending.append(item)
+
+            added = []
+            while pending:
+                by_shard: Dict[int, List[dict]] = {}
+                for item in pending:
+                    by_shard.setdefault(shard_for(item["current_pickup_point_id"], self.shards), []).append(item)
+                parts = list(by_shard.items())
+                results = await asyncio.gather(*(self.clients[shard].call("put_many", items=part) for shard, part in parts))
+                pending = []
+                for (_, part), result in zip(parts, results):
+                    duplicates = set(result["duplicates"])
+                    for item in part:
+                        if item["id"] in duplicates:
+                            # id появился в шарде мимо этого процесса - пробуем другой
+                            pending.append(dict(item, id=self._free_id(taken, next_id)))
+                        else:
+                            added.append(item)
+            return added
+
+    async def move(self, item_id: int, new_pickup_point_id: int) -> dict:
+        #перенос вещи между постоматами, в том числе между шардами
+        item = await self.locate(item_id)
+        if item is None:
+            raise ShardError("not_found", f"Вещь с ID {item_id} не найдена")
+        source = self.client_for(item["current_pickup_point_id"])
+        target = self.client_for(new_pickup_point_id)
+        taken = await source.call("take", item_id=item_id)
+        moved = dict(taken, current_pickup_point_id=new_pickup_point_id)
+        try:
+            return await target.call("put", item=moved)
+        except Exception:
+            # возвращаем вещь на место, чтобы она не потерялась
+            await source.call("put", item=taken)
+            raise
+
+    async def all_items(self) -> List[dict]:
+        return [item for part in await self.gather("items") for item in part]
+
+    async def stats(self) -> List[dict]:
+        return await self.gather("stats")
+
+
+router: Optional[ShardRouter] = ShardRouter(SHARDS) if SHARDS > 0 else None
+
+
+async def feed_events(shard: int) -> None:
+    #держит подписку на ленту шарда и публикует его события в ленту этого процесса
+    import events
+    while True:
+        client = ShardClient(shard)
+        try:
+            async for batch in client.stream("subscribe"):
+                for event in batch:
+                    events.publish(event["type"], **event["data"])
+        except (ShardError, ConnectionError, OSError) as e:
+            print(f"[SHARDS] Подписка на ленту шарда {shard} прервана: {e}")
+        finally:
+            client.close()
+        # события за время разрыва потеряны - подписчикам ленты нужен resync
+        events.broadcaster.restart()
+        await asyncio.sleep(1)
+
+
+# Подписки этого процесса на ленты шардов
+_feeds: List[asyncio.Task] = []
+
+
+def start_event_feeds() -> None:
+    #подписывается на ленты шардов при первом подписчике SSE: процессу приложения без
+    #подписчиков события шардов не нужны, а разбирать их все - работа, которая не делится между процессами
+    if not _feeds:
+        _feeds.extend(asyncio.create_task(feed_events(shard)) for shard in range(SHARDS))
+
+
+async def stop_event_feeds() -> None:
+    for task in _feeds:
+        task.cancel()
+    await asyncio.gather(*_feeds, return_exceptions=True)
+    _feeds.clear()
+
+
+#### сквозной замер
+
+# Постоматы, по которым раскладываются вещи замера (делятся поровну между 1, 2, 4 и 8 шардами)
+_BENCH_POINTS = range(1000, 1064)
+
+
+def _bench_items(count: int) -> List[dict]:
+    return [
+        {"id": 100000 + n, "desc": f"Вещь для замера {n % 100}", "hourly_price": 100,
+         "is_available_now": True, "current_pickup_point_id": _BENCH_POINTS[n % len(_BENCH_POINTS)], "reserved_until": None}
+        for n in range(count)
+    ]
+
+
+def bench_app():
+    #фабрика приложения для замера (uvicorn --factory): постоматы замера, а без шардов - и вещи
+    import main
+    import search
+    import services
+    from models import Item, Ppoint
+    services.pickup_points_db.extend(Ppoint(id=p, address=f"Постомат замера {p}", is_active=True) for p in _BENCH_POINTS)
+    if not enabled():
+        services.items_db.extend(Item.model_validate(item) for item in _bench_items(int(os.environ["BENCH_ITEMS"])))
+        search.rebuild(services.items_db)
+    return main.app
+
+
+def _bench_client(ports: List[int], orders: List[dict], concurrency: int, result_queue) -> None:
+    # отдельный процесс-клиент: заказы по keep-alive соединениям, concurrency соединений по портам по кругу
+    async def connection(port: int, queue: List[dict], statuses: Dict[int, int]):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while queue:
+            body = json.dumps(queue.pop()).encode()
+            writer.write(
+                b"POST /api/new_orders HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+            )
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+
+    async def main():
+        statuses: Dict[int, int] = {}
+        queue = list(orders)
+        await asyncio.gather(*(connection(ports[n % len(ports)], queue, statuses) for n in range(concurrency)))
+        result_queue.put(statuses)
+
+    asyncio.run(main())
+
+
+def _wait_ready(port: int, timeout: float = 60) -> None:
+    import urllib.request
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Приложение на порту {port} не поднялось за {timeout:g} с")
+
+
+def bench(shard_counts: List[int], items_per_process: int, workers: Optional[int], clients: int, concurrency: int, port: int) -> None:
+    #сквозной замер POST /api/new_orders: каждый заказ бронирует свою вещь и проходит весь путь
+    #(HTTP, контроль допуска выключен, создание, проверка, бронь, смена статуса, ответ).
+    #Вещей и заказов на процесс с данными (шард или единственный процесс при 0) - поровну,
+    #поэтому при линейном масштабировании время прогона не меняется, а заказов/с растет
+    import tempfile
+    global SHARD_SOCKET_DIR
+    base = None
+    print(f"{'shards':>6} {'workers':>7} {'orders':>8} {'seconds':>8} {'orders/s':>10} {'speedup':>8}  статусы")
+    for shards in shard_counts:
+        app_workers = 1 if shards == 0 else (workers or shards)
+        total = items_per_process * max(shards, 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, SHARDS=str(shards), SHARD_SOCKET_DIR=os.path.join(tmp, "sockets"),
+                       ARCHIVE_DIR=os.path.join(tmp, "archive"), ARCHIVE_INTERVAL_SECONDS="0",
+                       ADMISSION_ENABLED="false", BENCH_ITEMS=str(total))
+            shard_processes = []
+            if shards:
+                # шарды поднимаем с тем же окружением, что и приложение
+                os.environ.update(SHARD_SOCKET_DIR=env["SHARD_SOCKET_DIR"], ARCHIVE_DIR=env["ARCHIVE_DIR"])
+                SHARD_SOCKET_DIR = env["SHARD_SOCKET_DIR"]
+                shard_processes = start_shards(shards, seed=False, quiet=True)
+
+                async def fill():
+                    fill_router = ShardRouter(shards)
+                    await fill_router.add_many(_bench_items(total), lambda: random.randrange(100000, 1000000))
+                asyncio.run(fill())
+
+            # процессы приложения - отдельные uvicorn на своих портах, как за балансировщиком
+            ports = [port + n for n in range(app_workers)]
+            apps = [
+                subprocess.Popen(
+                    [sys.executable, "-m", "uvicorn", "sharding:bench_app", "--factory", "--port", str(app_port),
+                     "--log-level", "warning", "--no-access-log"],
+                    env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stdout=subprocess.DEVNULL
+                )
+                for app_port in ports
+            ]
+            try:
+                for app_port in ports:
+                    _wait_ready(app_port)
+                orders = [
+                    {"client_id": 123, "item_id": item["id"], "pickup_point_id": item["current_pickup_point_id"], "rental_duration_hours": 1}
+                    for item in _bench_items(total)
+                ]
+                random.Random(0).shuffle(orders)
+                queue = multiprocessing.Queue()
+                procs = [
+                    multiprocessing.Process(target=_bench_client, args=(ports, orders[c::clients], concurrency, queue))
+                    for c in range(clients)
+                ]
+                started = time.perf_counter()
+                for proc in procs:
+                    proc.start()
+                statuses: Dict[int, int] = {}
+                for _ in procs:
+                    for status, count in queue.get().items():
+                        statuses[status] = statuses.get(status, 0) + count
+                elapsed = time.perf_counter() - started
+                for proc in procs:
+                    proc.join()
+            finally:
+                for app in apps:
+                    app.terminate()
+                    app.wait()
+                for process in shard_processes:
+                    process.terminate()
+                    process.join()
+        rate = statuses.get(201, 0) / elapsed
+        base = base or rate
+        print(f"{shards:>6} {app_workers:>7} {total:>8} {elapsed:>8.2f} {rate:>10.0f} {rate / base:>7.2f}x  "
+              f"{json.dumps(statuses, sort_keys=True)}")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Шарды rent_service_api")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = sub.add_parser("serve", help="запустить процессы шардов")
+    serve_parser.add_argument("--shards", type=int, default=SHARDS or os.cpu_count())
+
+    bench_parser = sub.add_parser("bench", help="сквозной замер POST /api/new_orders по числу шардов")
+    bench_parser.add_argument("--shards", default="0,1,2,4", help="0 - без шардов, один процесс приложения")
+    bench_parser.add_argument("--items", type=int, default=2000, help="вещей и заказов на шард")
+    bench_parser.add_argument("--workers", type=int, default=None, help="процессов приложения (по умолчанию - по числу шардов)")
+    bench_parser.add_argument("--clients", type=int, default=2, help="процессов, подающих нагрузку")
+    bench_parser.add_argument("--concurrency", type=int, default=32, help="соединений на процесс нагрузки")
+    bench_parser.add_argument("--port", type=int, default=8765)
+
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        processes = start_shards(args.shards)
+        print(f"Запущено шардов: {args.shards}, сокеты в {SHARD_SOCKET_DIR}")
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+    else:
+        bench([int(s) for s in args.shards.split(",")], args.items, args.workers, args.clients, args.concurrency, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import analytics
+import archive
+import services
+from models import CancelReason, OrderCreateRequest, OrderStatus
+
+
+@pytest.fixture(autouse=True)
+def clean_state(tmp_path, monkeypatch):
+    #отдельный архив и исходные таблицы на каждый тест
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    archive.clear()
+
+    async def no_sms(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(services, "send_sms_cancellation", no_sms)
+    tables = services.dump_tables()
+    services.load_tables(dict(tables, orders_db=[]))
+    yield
+    services.load_tables(tables)
+    archive.clear()
+
+
+def create_order(item_id: int, pickup_point_id: int, hours: int, client_id: int = 123) -> int:
+    request = OrderCreateRequest(client_id=client_id, item_id=item_id, pickup_point_id=pickup_point_id, rental_duration_hours=hours)
+    return asyncio.run(services.create_order_in_db(request))
+
+
+def assert_consistent():
+    assert analytics.is_consistent(services.rebuild_analytics())
+
+
+def test_create_reserve_cancel_archive_agree_with_rebuild():
+    reserved = create_order(456, 789, 3)
+    asyncio.run(services.update_order_status(reserved, OrderStatus.AWAITING_PAYMENT))
+    asyncio.run(services.reserve_item(456, reserved, 3))
+    asyncio.run(services.update_order_status(reserved, OrderStatus.AWAITING_RETURN))
+    assert_consistent()
+
+    cancelled = create_order(457, 789, 5, client_id=124)
+    asyncio.run(services.cancel_order(124, cancelled, CancelReason.ITEM_NOT_AVAILABLE, "уже забронирована"))
+    assert_consistent()
+
+    returned = create_order(458, 123, 2)
+    asyncio.run(services.update_order_status(returned, OrderStatus.AWAITING_PAYMENT))
+    asyncio.run(services.update_order_status(returned, OrderStatus.RETURNED))
+    assert_consistent()
+
+    # завершенные заказы уходят в архив, агрегаты по ним остаются
+    archived = asyncio.run(services.archive_finished_orders(min_age_hours=0, now=datetime.now() + timedelta(seconds=1)))
+    assert archived == 2
+    assert [o.id for o in services.orders_db] == [reserved]
+    assert_consistent()
+
+    item_stats = analytics.get_item_stats(456)
+    assert item_stats["active_rentals"] == 1
+    assert item_stats["revenue"] == 3 * 50
+    assert analytics.get_item_stats(457)["cancel_reasons"][CancelReason.ITEM_NOT_AVAILABLE.value] == 1
+    assert analytics.get_pickup_point_stats(123)["booked_hours"] == 2
+
+
+def test_rebuild_replace_restores_counters():
+    order_id = create_order(456, 789, 4)
+    asyncio.run(services.update_order_status(order_id, OrderStatus.AWAITING_PAYMENT))
+    # счетчики испорчены - пересчет с replace=True восстанавливает их
+    analytics.reset()
+    assert not analytics.is_consistent(services.rebuild_analytics())
+    services.rebuild_analytics(replace=True)
+    assert_consistent()
+
+
+def test_startup_seeds_counters_from_archive():
+    cancelled = create_order(457, 789, 5, client_id=124)
+    asyncio.run(services.cancel_order(124, cancelled, CancelReason.ITEM_NOT_AVAILABLE, "уже забронирована"))
+    asyncio.run(services.archive_finished_orders(min_age_hours=0, now=datetime.now() + timedelta(seconds=1)))
+    create_order(457, 789, 2)
+
+    # рестарт: архив остался на диске, счетчики в памяти пустые
+    analytics.reset()
+    with archive._lock:
+        archive._segments.clear()
+        archive._loaded = False
+    assert not analytics.is_consistent(services.rebuild_analytics())
+
+    import main
+    asyncio.run(main.load_analytics())
+    assert_consistent()
+    assert analytics.get_item_stats(457)["orders"] == 2
+    assert analytics.get_item_stats(457)["cancelled"] == 1
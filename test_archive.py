@@ -0,0 +1,151 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+import services
+from models import Order, OrderStatus
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(archive, "ARCHIVE_BLOCK_SIZE", 16)
+    archive.clear()
+    yield tmp_path / "archive"
+    archive.clear()
+
+
+@pytest.fixture
+def block_reads(monkeypatch):
+    #считает прочитанные блоки
+    reads = []
+    read_block = archive._read_block
+
+    def counting(seg_path, entry):
+        reads.append(seg_path)
+        return read_block(seg_path, entry)
+
+    monkeypatch.setattr(archive, "_read_block", counting)
+    return reads
+
+
+def make_orders(ids):
+    now = datetime(2025, 1, 1)
+    return [
+        Order(id=order_id, client_id=123, item_id=456, pickup_point_id=789, rental_duration_hours=1,
+              status=OrderStatus.RETURNED, created_at=now, updated_at=now)
+        for order_id in ids
+    ]
+
+
+def archive_batches(batches: int, per_batch: int, seed: int = 0):
+    ids = random.Random(seed).sample(range(100000, 1000000), batches * per_batch)
+    for n in range(batches):
+        archive.append_orders(make_orders(ids[n * per_batch:(n + 1) * per_batch]))
+    return ids
+
+
+def reload_from_disk():
+    with archive._lock:
+        archive._segments.clear()
+        archive._loaded = False
+
+
+def test_bloom_filter_limits_block_reads(monkeypatch, block_reads):
+    monkeypatch.setattr(archive, "ARCHIVE_COMPACT_SEGMENTS", 100)
+    ids = archive_batches(30, 100)
+    assert archive.segments_count() == 30
+
+    for order_id in ids[::10]:
+        assert archive.get_order(order_id).id == order_id
+    # диапазоны id всех сегментов перекрываются, но читаем почти всегда один блок
+    assert len(block_reads) <= len(ids[::10]) * 1.3
+
+    block_reads.clear()
+    missing = [i for i in range(100000, 101000) if i not in set(ids)]
+    assert all(archive.get_order(i) is None for i in missing)
+    assert len(block_reads) <= len(missing) * 30 * 0.05
+
+
+def test_compaction_merges_small_segments(monkeypatch, archive_dir):
+    monkeypatch.setattr(archive, "ARCHIVE_COMPACT_SEGMENTS", 3)
+    ids = archive_batches(3, 50)
+    assert archive.segments_count() == 3
+
+    archive_batches(1, 50, seed=1)
+    ids += random.Random(1).sample(range(100000, 1000000), 50)
+    # четвертый мелкий сегмент запускает слияние в один
+    assert archive.segments_count() == 1
+    assert len(list(archive_dir.glob("segment_*.seg"))) == 1
+    assert all(archive.get_order(order_id).id == order_id for order_id in ids)
+
+    reload_from_disk()
+    assert archive.segments_count() == 1
+    assert sorted(o.id for o in archive.iter_orders()) == sorted(ids)
+
+
+def test_compaction_splits_into_full_segments(monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_COMPACT_SEGMENTS", 100)
+    monkeypatch.setattr(archive, "ARCHIVE_SEGMENT_SIZE", 120)
+    ids = archive_batches(5, 50)
+    assert archive.compact(force=True) == 5
+    counts = sorted(s.count for s in archive._segments)
+    assert counts == [10, 120, 120]
+    assert all(archive.get_order(order_id) is not None for order_id in ids)
+
+
+def test_iter_orders_survives_compaction(monkeypatch, archive_dir):
+    monkeypatch.setattr(archive, "ARCHIVE_COMPACT_SEGMENTS", 100)
+    ids = archive_batches(4, 40)
+    old_files = set(archive_dir.glob("segment_*.seg"))
+
+    stream = archive.iter_orders()
+    seen = [next(stream).id for _ in range(10)]
+    assert archive.compact(force=True) == 4
+    # слитые сегменты еще читаются - файлы на месте до конца выгрузки
+    assert old_files <= set(archive_dir.glob("segment_*.seg"))
+    seen += [order.id for order in stream]
+    assert sorted(seen) == sorted(ids)
+    assert not old_files & set(archive_dir.glob("segment_*.seg"))
+    assert archive.segments_count() == 1
+
+
+def test_archive_pass_does_not_block_event_loop(monkeypatch):
+    slow_append = archive.append_orders
+
+    def append_orders(orders):
+        time.sleep(0.3)
+        return slow_append(orders)
+
+    monkeypatch.setattr(archive, "append_orders", append_orders)
+    tables = services.dump_tables()
+    services.orders_db[:] = make_orders([111111, 222222])
+    services.orders_db.append(make_orders([333333])[0].model_copy(update={"status": OrderStatus.AWAITING_RETURN}))
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        archived = await services.archive_finished_orders(min_age_hours=1)
+        task.cancel()
+        return archived, ticks
+
+    try:
+        archived, ticks = asyncio.run(run())
+        assert archived == 2
+        assert ticks >= 10
+        assert [o.id for o in services.orders_db] == [333333]
+        assert archive.get_order(111111).status == OrderStatus.RETURNED
+    finally:
+        services.load_tables(tables)
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+import bulk_import
+import services
+
+
+@pytest.fixture(autouse=True)
+def no_pool(monkeypatch):
+    monkeypatch.setattr(bulk_import, "IMPORT_WORKERS", 0)
+
+
+def run_import(data: bytes, fmt: str = "csv"):
+    async def body():
+        yield data
+
+    return asyncio.run(bulk_import.import_items(body(), fmt, dry_run=True))
+
+
+def test_non_utf8_row_reported_as_row_error():
+    ppoint = services.pickup_points_db[0].id
+    data = f"desc,hourly_price,current_pickup_point_id\nДрель,100,{ppoint}\n".encode() + b"\xff\xfe,100,1\n"
+    data += f"\nШуруповерт,abc,{ppoint}\nПила,50,{ppoint}\n".encode()
+    report = run_import(data)
+    assert report["imported"] == 2
+    assert [e["row"] for e in report["errors"]] == [3, 5]
+    assert "UTF-8" in report["errors"][0]["errors"][0]
+
+
+def test_non_utf8_header_rejected():
+    with pytest.raises(bulk_import.ImportFormatError, match="UTF-8"):
+        run_import(b"desc,hourly_price,current_pickup_point_id\xff\n")
+
+
+def test_rows_over_id_space_reported():
+    taken = set(range(100000, 100000 + bulk_import.ID_SPACE - 1))
+    items, errors = bulk_import._build_items(taken, [(2, "Дрель", 100, 1), (3, "Пила", 50, 1)])
+    assert [i.id for i in items] == [999999]
+    assert errors == [{"row": 3, "errors": ["Нет свободных id для item: шестизначных id всего 900000"]}]
@@ -0,0 +1,136 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import codec
+import services
+from models import OrderStatus, RentalOrderMessage
+
+
+def message(**fields) -> RentalOrderMessage:
+    values = dict(
+        order_id=123456,
+        client_id=123,
+        item_id=456,
+        pickup_point_id=789,
+        rental_duration_hours=24,
+        status=OrderStatus.AWAITING_PAYMENT,
+        timestamp=datetime(2025, 6, 1, 12, 30, 15, 123456)
+    )
+    values.update(fields)
+    return RentalOrderMessage(**values)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2, 42, 2024])
+def test_round_trip_random_messages(seed):
+    rng = random.Random(seed)
+    codec.check_round_trip([codec.random_message(rng) for _ in range(2000)])
+
+
+@pytest.mark.parametrize("timestamp", [
+    datetime(2025, 6, 1, 12, 0, tzinfo=timezone.utc),
+    datetime(2025, 6, 1, 12, 0, tzinfo=timezone(timedelta(hours=3))),
+    datetime(2025, 6, 1, 12, 0, tzinfo=timezone(timedelta(hours=-12))),
+    datetime(1969, 12, 31, 23, 59, 59, 999999),
+    datetime(1900, 1, 1),
+    datetime(1960, 5, 5, tzinfo=timezone(timedelta(hours=5, minutes=30))),
+    datetime(1970, 1, 1)
+])
+def test_round_trip_timestamps(timestamp):
+    original = message(timestamp=timestamp)
+    decoded = codec.decode(codec.encode(original, "binary"))
+    assert decoded.timestamp == original.timestamp
+    assert (decoded.timestamp.tzinfo is None) == (timestamp.tzinfo is None)
+
+
+def test_round_trip_max_field_values():
+    original = message(order_id=2**32 - 1, client_id=2**32 - 1, item_id=2**32 - 1,
+                       pickup_point_id=2**32 - 1, rental_duration_hours=2**16 - 1)
+    data = codec.encode(original, "binary")
+    assert len(data) == 29
+    assert codec.decode(data) == original
+
+
+@pytest.mark.parametrize("status", list(OrderStatus))
+def test_round_trip_every_status(status):
+    assert codec.decode(codec.encode(message(status=status), "binary")).status == status
+
+
+@pytest.mark.parametrize("fields", [{"order_id": 2**32}, {"item_id": -1}, {"rental_duration_hours": 2**16}])
+def test_encode_out_of_schema_raises(fields):
+    with pytest.raises(codec.CodecError):
+        codec.encode(message(**fields), "binary")
+
+
+def test_decode_unknown_version():
+    data = bytearray(codec.encode(message(), "binary"))
+    data[0] = 200
+    with pytest.raises(codec.CodecError, match="версия схемы 200"):
+        codec.decode(bytes(data))
+
+
+@pytest.mark.parametrize("cut", [1, 10, 28])
+def test_decode_truncated_payload(cut):
+    with pytest.raises(codec.CodecError):
+        codec.decode(codec.encode(message(), "binary")[:cut])
+
+
+def test_decode_unknown_status_and_empty():
+    data = bytearray(codec.encode(message(), "binary"))
+    data[20] = 99
+    with pytest.raises(codec.CodecError, match="статуса 99"):
+        codec.decode(bytes(data))
+    with pytest.raises(codec.CodecError):
+        codec.decode(b"")
+
+
+def test_decode_json():
+    original = message(timestamp=datetime(2025, 6, 1, tzinfo=timezone.utc))
+    assert codec.decode(codec.encode(original, "json")) == original
+
+
+def test_encode_for_kafka_falls_back_to_json():
+    payload, content_type = codec.encode_for_kafka(message())
+    assert content_type == codec.CONTENT_TYPES["binary"] and len(payload) == 29
+
+    big = message(order_id=2**40)
+    payload, content_type = codec.encode_for_kafka(big)
+    assert content_type == codec.CONTENT_TYPES["json"]
+    assert codec.decode(payload) == big
+
+
+def test_send_to_kafka_does_not_fail_on_out_of_schema_message(monkeypatch):
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(services.asyncio, "sleep", no_sleep)
+    asyncio.run(services.send_to_kafka(message(order_id=2**32, rental_duration_hours=100000)))
+
+
+@pytest.mark.parametrize("fmt", ["binary", "json"])
+def test_decode_fields_matches_decode(fmt):
+    original = message(timestamp=datetime(2025, 6, 1, 12, 0, tzinfo=timezone(timedelta(hours=3))))
+    data = codec.encode(original, fmt)
+    fields = codec.decode_fields(data)
+    assert fields == tuple(getattr(codec.decode(data), field) for field in codec.FIELDS)
+    assert dict(zip(codec.FIELDS, fields))["status"] is OrderStatus.AWAITING_PAYMENT
+
+
+def test_decode_fields_rejects_bad_payloads():
+    data = bytearray(codec.encode(message(), "binary"))
+    data[20] = 99
+    with pytest.raises(codec.CodecError, match="статуса 99"):
+        codec.decode_fields(bytes(data))
+    with pytest.raises(codec.CodecError):
+        codec.decode_fields(b'{"order_id": 1}')
+    with pytest.raises(codec.CodecError):
+        codec.decode_fields(b"")
+
+
+def test_check_format():
+    assert codec.check_format("binary") == "binary"
+    assert codec.check_format("json") == "json"
+    with pytest.raises(codec.CodecError, match="protobuf"):
+        codec.check_format("protobuf")
@@ -0,0 +1,60 @@
+import pytest
+
+import search
+from models import Item
+
+
+@pytest.fixture(autouse=True)
+def empty_index():
+    search.rebuild([])
+    yield
+    search.rebuild([])
+
+
+def item(item_id: int, desc: str = "Дрель ударная", available: bool = True, ppoint: int = 1, price: int = 100) -> Item:
+    return Item.model_construct(id=item_id, desc=desc, hourly_price=price, is_available_now=available,
+                                current_pickup_point_id=ppoint, reserved_until=None)
+
+
+def found_ids(results):
+    return [r["item_id"] for r in results]
+
+
+def test_reserved_items_leave_available_index():
+    search.rebuild([item(1), item(2, ppoint=2), item(3, "Дрель ударная аккумуляторная")])
+    assert found_ids(search.search("дрель")) == [1, 2, 3]
+
+    search.index_item(item(1, available=False))
+    assert found_ids(search.search("дрель")) == [2, 3]
+    assert found_ids(search.search("дрель", available_only=False)) == [1, 2, 3]
+    assert [g["item_ids"] for g in search.alternatives(2)] == [[3]]
+
+    search.index_item(item(1))
+    assert found_ids(search.search("дрель")) == [1, 2, 3]
+    assert search.stats()["available_items"] == 3
+
+
+def test_pickup_point_filter_follows_moves():
+    search.rebuild([item(1), item(2, ppoint=2)])
+    assert found_ids(search.search("дрель", pickup_point_id=2)) == [2]
+
+    search.index_item(item(1, ppoint=2))
+    assert found_ids(search.search("дрель", pickup_point_id=2)) == [1, 2]
+    assert search.search("дрель", pickup_point_id=1) == []
+    assert found_ids(search.search("дрель", available_only=False, pickup_point_id=2)) == [1, 2]
+
+
+def test_exact_matches_rank_first():
+    search.rebuild([item(1, "Дрель ударная мощная", price=10), item(2, price=500), item(3, "Пила")])
+    results = search.search("дрель ударная")
+    assert found_ids(results) == [2, 1]
+    assert results[0]["score"] == 1.0
+
+
+def test_scan_limit_caps_candidates(monkeypatch):
+    monkeypatch.setattr(search, "SEARCH_SCAN_LIMIT", 10)
+    search.rebuild([item(i, "Дрель ударная", available=i % 2 == 0) for i in range(1000)] +
+                   [item(i, "Дрель", available=False) for i in range(1000, 2000)])
+    assert len(search.search("дрель", limit=100)) == 10
+    assert len(search.search("дрель", available_only=False, limit=100)) == 10
+    assert all(r["is_available_now"] for r in search.search("дрель", limit=100))
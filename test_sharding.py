@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import archive
+import services
+import sharding
+from models import CancelReason, OrderCreateRequest, OrderStatus
+
+SHARDS = 4
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    #процессы шардов над исходными таблицами, этот процесс - как процесс приложения
+    monkeypatch.setattr(sharding, "SHARD_SOCKET_DIR", str(tmp_path / "sockets"))
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    processes = sharding.start_shards(SHARDS, quiet=True)
+    monkeypatch.setattr(sharding, "SHARDS", SHARDS)
+    monkeypatch.setattr(sharding, "router", sharding.ShardRouter(SHARDS))
+
+    async def no_sms(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(services, "send_sms_cancellation", no_sms)
+    yield
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def order(item_id: int, pickup_point_id: int, hours: int = 2) -> OrderCreateRequest:
+    return OrderCreateRequest(client_id=123, item_id=item_id, pickup_point_id=pickup_point_id, rental_duration_hours=hours)
+
+
+def test_order_pipeline_runs_in_owning_shard(shards):
+    async def scenario():
+        placed = await services.place_order(order(456, 789))
+        assert placed.status == OrderStatus.AWAITING_PAYMENT
+        # id заказа указывает на шард его постомата
+        assert placed.id % SHARDS == sharding.shard_for(789)
+        assert (await services.get_order(placed.id)).status == OrderStatus.AWAITING_PAYMENT
+
+        # вещь 458 в постомате 123 (другой шард): заказ создан и его нужно отменить
+        with pytest.raises(services.ItemNotInLocationError) as error:
+            await services.place_order(order(458, 789))
+        await services.cancel_order(123, error.value.order_id, CancelReason.ITEM_NOT_IN_LOCATION, str(error.value))
+        with pytest.raises(services.ItemNotAvailableError):
+            await services.place_order(order(456, 789))
+
+        statuses = sorted(o["status"] for part in [p async for p in services.iter_orders()] for o in part)
+        assert statuses == ["awaiting_payment", "cancelled", "new"]
+        rebuilt = await services.get_analytics(rebuild=True)
+        assert rebuilt["consistent"]
+        assert rebuilt["items"][456]["active_rentals"] == 1
+        assert (await services.get_pickup_point_analytics(789))["orders"] == 3
+
+    asyncio.run(scenario())
+
+
+def test_move_between_shards(shards):
+    async def scenario():
+        await services.place_order(order(456, 789))
+        with pytest.raises(services.ItemNotAvailableError):
+            await services.move_item(456, 123)
+
+        moved = await services.move_item(458, 789)
+        assert moved.current_pickup_point_id == 789
+        # поисковый индекс переехал вместе с вещью
+        assert [r["item_id"] for r in await services.search_items("пауэрбанк", pickup_point_id=789)] == [458]
+        assert await services.search_items("пауэрбанк", pickup_point_id=123) == []
+        with pytest.raises(services.ItemNotInLocationError):
+            await services.place_order(order(458, 123))
+        assert (await services.place_order(order(458, 789))).status == OrderStatus.AWAITING_PAYMENT
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_tables_reads_shards(shards):
+    async def scenario():
+        placed = await services.place_order(order(458, 123))
+        tables = await services.snapshot_tables()
+        assert sorted(i["id"] for i in tables["items_db"]) == [456, 457, 458]
+        assert [o["id"] for o in tables["orders_db"]] == [placed.id]
+        assert len(tables["clients_db"]) == 2
+
+    asyncio.run(scenario())
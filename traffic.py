@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import hmac
+import hashlib
+import secrets
+from typing import Dict, List, Optional, Tuple
+
+# Запись реального трафика для нагрузочного воспроизведения (см. replay.py).
+# Трасса - JSONL-файл. Первая строка - снимок таблиц services на момент старта
+# записи, дальше по строке на запрос:
+#   t - время от старта записи, с; m - метод; p - путь; q - query string;
+#   b - тело запроса (JSON); s - статус ответа; d - длительность, с;
+#   r - id из ответа /api/new_items и /api/new_clients (чтобы при воспроизведении
+#       подставить новые id в последующие заказы).
+# При anonymize client_id и персональные данные клиентов заменяются
+# псевдонимами на HMAC с солью записи: один клиент - всегда один псевдоним,
+# поэтому перекос нагрузки по клиентам сохраняется.
+
+TRAFFIC_CAPTURE_FILE = os.getenv("TRAFFIC_CAPTURE_FILE", "traffic.jsonl")
+TRAFFIC_CAPTURE_PATHS = tuple(
+    path for path in os.getenv(
+        "TRAFFIC_CAPTURE_PATHS",
+        "/api/new_orders,/api/new_items,/api/new_clients,/api/get_items,/api/get_orders"
+    ).split(",") if path
+)
+# Сбрасываем буфер файла каждые N записей
+TRAFFIC_FLUSH_EVERY = int(os.getenv("TRAFFIC_FLUSH_EVERY", "100"))
+
+# Пути, для которых запоминаем id из ответа
+_CREATED_ID_PATHS = ("/api/new_items", "/api/new_clients")
+
+
+class TrafficRecorder:
+    def __init__(self):
+        self.enabled = False
+        self.anonymize = False
+        self.paths: Tuple[str, ...] = TRAFFIC_CAPTURE_PATHS
+        self.file_path: Optional[str] = None
+        self.records = 0
+        self._file = None
+        self._start = 0.0
+        self._salt = b""
+
+    def pseudonym_id(self, value: int) -> int:
+        #стабильный шестизначный псевдоним для id
+        digest = hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+        return 100000 + int.from_bytes(digest[:4], "big") % 900000
+
+    def _pseudonym_text(self, kind: str, value: str) -> str:
+        return hmac.new(self._salt, f"{kind}:{value}".encode(), hashlib.sha256).hexdigest()[:12]
+
+    def _anonymize_client(self, client: Dict) -> Dict:
+        client = dict(client)
+        if "id" in client:
+            client["id"] = self.pseudonym_id(client["id"])
+        if "name" in client:
+            client["name"] = "client-" + self._pseudonym_text("name", str(client["name"]))
+        if "phone" in client:
+            digits = str(int(self._pseudonym_text("phone", str(client["phone"])), 16))[-10:]
+            client["phone"] = "+7" + digits.rjust(10, "0")
+        if "email" in client:
+            client["email"] = self._pseudonym_text("email", str(client["email"])) + "@example.com"
+        return client
+
+    def _anonymize_body(self, path: str, body):
+        if not isinstance(body, dict):
+            return body
+        if path == "/api/new_clients":
+            return self._anonymize_client(body)
+        if "client_id" in body and isinstance(body["client_id"], int):
+            body = dict(body)
+            body["client_id"] = self.pseudonym_id(body["client_id"])
+        return body
+
+    def start(self, tables: Dict[str, List[Dict]], file_path: Optional[str] = None, anonymize: bool = False,
+              paths: Optional[Tuple[str, ...]] = None) -> Dict:
+        #начинает новую трассу: пишет снимок таблиц и включает запись
+        self.stop()
+        self.file_path = file_path or TRAFFIC_CAPTURE_FILE
+        self.anonymize = anonymize
+        self.paths = paths or TRAFFIC_CAPTURE_PATHS
+        self._salt = secrets.token_bytes(16)
+        if anonymize:
+            tables = dict(tables)
+            tables["clients_db"] = [self._anonymize_client(c) for c in tables["clients_db"]]
+            tables["orders_db"] = [dict(o, client_id=self.pseudonym_id(o["client_id"])) for o in tables["orders_db"]]
+        self._file = open(self.file_path, "w", encoding="utf-8")
+        self._file.write(json.dumps({"snapshot": tables, "anonymized": anonymize}, ensure_ascii=False, default=str) + "\n")
+        self._start = time.perf_counter()
+        self.records = 0
+        self.enabled = True
+        print(f"[TRAFFIC] Запись трафика в {self.file_path}")
+        return self.status()
+
+    def stop(self) -> Dict:
+        self.enabled = False
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            print(f"[TRAFFIC] Запись трафика остановлена, записей: {self.records}")
+        return self.status()
+
+    def status(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "file": self.file_path,
+            "anonymize": self.anonymize,
+            "paths": list(self.paths),
+            "records": self.records
+        }
+
+    def matches(self, path: str) -> bool:
+        return any(path == p or path.startswith(p + "/") for p in self.paths)
+
+    def write(self, started: float, method: str, path: str, query: str, body: bytes, status_code: int,
+              duration: float, response_body: bytes) -> None:
+        if self._file is None:
+            return
+        record = {"t": round(started - self._start, 6), "m": method, "p": path}
+        if query:
+            record["q"] = query
+        if body:
+            try:
+                parsed = json.loads(body)
+            except ValueError:
+                parsed = body.decode("utf-8", "replace")
+            record["b"] = self._anonymize_body(path, parsed) if self.anonymize else parsed
+        record["s"] = status_code
+        record["d"] = round(duration, 6)
+        if path in _CREATED_ID_PATHS and response_body and status_code == 201:
+            try:
+                created_id = json.loads(response_body)["id"]
+                if self.anonymize and path == "/api/new_clients":
+                    created_id = self.pseudonym_id(created_id)
+                record["r"] = created_id
+            except (ValueError, KeyError, TypeError):
+                pass
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.records += 1
+        if self.records % TRAFFIC_FLUSH_EVERY == 0:
+            self._file.flush()
+
+
+recorder = TrafficRecorder()
+
+
+class TrafficCaptureMiddleware:
+    #ASGI middleware записи трафика, при выключенной записи только проверяет флаг
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not recorder.enabled or scope["type"] != "http" or not recorder.matches(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        body_parts = []
+        response_parts = []
+        status_code = 500
+        keep_response = scope["path"] in _CREATED_ID_PATHS
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                body_parts.append(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body" and keep_response:
+                response_parts.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            recorder.write(
+                started,
+                scope["method"],
+                scope["path"],
+                scope.get("query_string", b"").decode("latin-1"),
+                b"".join(body_parts),
+                status_code,
+                time.perf_counter() - started,
+                b"".join(response_parts)
+            )